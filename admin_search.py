@@ -0,0 +1,182 @@
+"""
+In-memory search index behind the admin product and user listings.
+
+Rows are loaded once without the image/avatar blobs and kept pre-sorted for
+every sortable column, so a page is a bisect to the keyset cursor followed by
+a short scan - independent of catalogue size. Queries match case-insensitive
+prefixes of any word (served from a sorted token list) or, failing that,
+substrings of the searchable fields.
+
+The index is marked stale by a flush hook whenever a Users/Products row is
+written and rebuilt on the next request; SEARCH_INDEX_TTL (seconds) bounds
+staleness across gunicorn workers. Indexes are kept per site.
+"""
+import os
+import json
+import time
+import base64
+import bisect
+import threading
+from sqlalchemy import event
+from sqlalchemy.orm import Session, load_only
+from models import Users, Products
+import sites
+import db_routing
+
+MAX_PAGE = 200
+
+def _product_row(p):
+    row = p.to_dict()
+    row['has_image'] = bool(p.image_url)
+    return row
+
+def _user_row(u):
+    row = u.to_dict()
+    row['has_pin'] = bool(u.pin)
+    return row
+
+# kind -> (model, columns loaded, primary key, searchable fields, sortable fields, row builder)
+_SPECS = {
+    'products': (Products,
+                 ['upc_code', 'manufacturer', 'description', 'size', 'price', 'stock_level',
+                  'is_quick_item', 'category', 'image_url'],
+                 'upc_code', ('description', 'manufacturer', 'upc_code'),
+                 ('description', 'manufacturer', 'upc_code', 'price', 'stock_level', 'category'),
+                 _product_row),
+    'users': (Users,
+              ['user_id', 'first_name', 'last_name', 'screen_name', 'card_id', 'balance',
+               'is_admin', 'is_super_admin', 'avatar', 'pin'],
+              'user_id', ('first_name', 'last_name', 'screen_name', 'card_id'),
+              ('last_name', 'first_name', 'screen_name', 'card_id', 'balance'),
+              _user_row),
+}
+
+_indexes = {}  # (site id, kind) -> _Index
+_versions = {kind: 0 for kind in _SPECS}  # bumped on every write; an index built at an older version is stale
+_lock = threading.Lock()
+
+def _ttl():
+    return int(os.environ.get('SEARCH_INDEX_TTL', '120'))
+
+def invalidate(kind=None):
+    """Mark one index (or all) for rebuild on next use - for bulk UPDATE/DELETE statements."""
+    with _lock:
+        for k in ([kind] if kind else _SPECS):
+            _versions[k] += 1
+
+@event.listens_for(Session, 'after_flush')
+def _invalidate_on_flush(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Users):
+            invalidate('users')
+        elif isinstance(obj, Products):
+            invalidate('products')
+
+def _sort_value(value):
+    # Keep mixed None/str/number columns comparable: (type rank, value)
+    if value is None or value == "":
+        return (0, "")
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return (1, value)
+    return (2, str(value).lower())
+
+class _Index:
+    def __init__(self, kind, version):
+        self.version = version
+        model, columns, pk, search_fields, sort_fields, build_row = _SPECS[kind]
+        objs = model.query.options(load_only(*[getattr(model, c) for c in columns])).all()
+        self.pk = pk
+        self.rows = {}
+        self.text = {}
+        tokens = []
+        for obj in objs:
+            row = build_row(obj)
+            key = row[pk]
+            self.rows[key] = row
+            words = [str(row[f]).lower() for f in search_fields if row.get(f) not in (None, "")]
+            self.text[key] = ' '.join(words)
+            for word in set(' '.join(words).split()):
+                tokens.append((word, _sort_value(key), key))
+        tokens.sort()
+        self.tokens = tokens
+        self.token_keys = [t[0] for t in tokens]
+        # Per sort field: list of ((sort value, pk sort value), pk) in ascending order
+        self.orders = {}
+        for field in sort_fields:
+            entries = sorted(((_sort_value(row[field]), _sort_value(key)), key) for key, row in self.rows.items())
+            self.orders[field] = ([e[0] for e in entries], [e[1] for e in entries])
+        self.built = time.monotonic()
+
+    def matching(self, q):
+        """Set of primary keys matching q, or None for 'everything'."""
+        q = q.strip().lower()
+        if not q:
+            return None
+        lo = bisect.bisect_left(self.token_keys, q)
+        hits = set()
+        for word, _, key in self.tokens[lo:]:
+            if not word.startswith(q):
+                break
+            hits.add(key)
+        if not hits or ' ' in q:
+            hits.update(k for k, text in self.text.items() if q in text)
+        return hits
+
+    def page(self, q, sort, descending, limit, after):
+        sort_keys, keys = self.orders[sort]
+        hits = self.matching(q)
+        if after is None:
+            pos = len(keys) - 1 if descending else 0
+        elif descending:
+            pos = bisect.bisect_left(sort_keys, after) - 1
+        else:
+            pos = bisect.bisect_right(sort_keys, after)
+        step = -1 if descending else 1
+        items, last = [], None
+        while 0 <= pos < len(keys) and len(items) < limit:
+            key = keys[pos]
+            if hits is None or key in hits:
+                items.append(self.rows[key])
+                last = sort_keys[pos]
+            pos += step
+        more = any(hits is None or keys[p] in hits for p in _remaining(pos, len(keys), step))
+        return items, (encode_cursor(last) if last is not None and more else None)
+
+def _remaining(pos, n, step):
+    while 0 <= pos < n:
+        yield pos
+        pos += step
+
+def encode_cursor(sort_key):
+    return base64.urlsafe_b64encode(json.dumps(sort_key).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor; returns None for missing or malformed cursors."""
+    if not cursor:
+        return None
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return tuple(tuple(part) for part in raw)
+    except (ValueError, TypeError):
+        return None
+
+def _get(kind):
+    key = (sites.current_id(), kind)
+    with _lock:
+        version = _versions[kind]
+        idx = _indexes.get(key)
+        if idx and idx.version == version and time.monotonic() - idx.built < _ttl():
+            return idx
+    with db_routing.use_primary():
+        idx = _Index(kind, version)
+    with _lock:
+        _indexes[key] = idx
+    return idx
+
+def search(kind, q='', sort=None, descending=False, limit=50, after=None):
+    """One page of listing rows for 'products' or 'users'. Returns (items, next_cursor)."""
+    sortable = _SPECS[kind][4]
+    if sort not in sortable:
+        sort = sortable[0]
+    limit = max(1, min(int(limit), MAX_PAGE))
+    return _get(kind).page(q or '', sort, descending, limit, decode_cursor(after))
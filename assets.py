@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Static asset pipeline.
+
+Build step (run once per deploy, see the GitHub workflow):
+    python assets.py
+
+Copies every file under static/ into static/dist/ with a content hash in its
+name, writes gzip/brotli variants of text assets next to it, and records the
+mapping in static/dist/manifest.json.
+
+At runtime init_app() rewrites url_for('static', filename=...) to the hashed
+name, serves the precompressed variant the client accepts with a year-long
+immutable Cache-Control, and gzips HTML/JSON responses on the fly. Without a
+manifest (local dev) everything falls back to plain Flask static serving.
+"""
+import os
+import gzip
+import json
+import shutil
+import hashlib
+import mimetypes
+from flask import request, send_from_directory
+
+try:
+    import brotli
+except ImportError:  # brotli variants are optional; gzip is always produced
+    brotli = None
+
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+PRECOMPRESS_EXTENSIONS = {'.css', '.js', '.svg', '.json', '.txt', '.html'}
+COMPRESS_MIMETYPES = {'text/html', 'application/json'}
+COMPRESS_MIN_BYTES = 500
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+def _hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+    return h.hexdigest()[:12]
+
+def build(static_folder):
+    """Fingerprint and precompress everything in static_folder. Returns the manifest."""
+    dist = os.path.join(static_folder, DIST_DIR)
+    shutil.rmtree(dist, ignore_errors=True)
+    os.makedirs(dist)
+    manifest = {}
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != dist]
+        for name in files:
+            src = os.path.join(root, name)
+            rel = os.path.relpath(src, static_folder).replace(os.sep, '/')
+            stem, ext = os.path.splitext(rel)
+            hashed = f"{DIST_DIR}/{stem}.{_hash_file(src)}{ext}"
+            dest = os.path.join(static_folder, hashed)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            shutil.copyfile(src, dest)
+            if ext.lower() in PRECOMPRESS_EXTENSIONS:
+                with open(src, 'rb') as f:
+                    raw = f.read()
+                with open(dest + '.gz', 'wb') as f:
+                    f.write(gzip.compress(raw, compresslevel=9, mtime=0))
+                if brotli:
+                    with open(dest + '.br', 'wb') as f:
+                        f.write(brotli.compress(raw, quality=11))
+            manifest[rel] = hashed
+    with open(os.path.join(dist, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+def load_manifest(static_folder):
+    try:
+        with open(os.path.join(static_folder, DIST_DIR, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def init_app(app):
+    """Wire fingerprinted URLs, precompressed static serving and HTML/JSON gzip into app."""
+    folder = app.static_folder
+    manifest = load_manifest(folder)
+
+    @app.url_defaults
+    def _fingerprint_static(endpoint, values):
+        if endpoint == 'static' and values.get('filename') in manifest:
+            values['filename'] = manifest[values['filename']]
+
+    def _serve_static(filename):
+        if not filename.startswith(DIST_DIR + '/'):
+            return app.send_static_file(filename)
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        accepted = request.accept_encodings
+        resp = None
+        for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if accepted[encoding] and os.path.isfile(os.path.join(folder, filename + suffix)):
+                resp = send_from_directory(folder, filename + suffix, mimetype=mimetype)
+                resp.headers['Content-Encoding'] = encoding
+                break
+        if resp is None:
+            resp = send_from_directory(folder, filename)
+        resp.headers['Cache-Control'] = IMMUTABLE
+        resp.vary.add('Accept-Encoding')
+        return resp
+
+    app.view_functions['static'] = _serve_static
+
+    @app.after_request
+    def _compress_response(resp):
+        if (resp.mimetype not in COMPRESS_MIMETYPES or resp.direct_passthrough or resp.is_streamed
+                or resp.status_code < 200 or resp.status_code >= 300
+                or 'Content-Encoding' in resp.headers
+                or not request.accept_encodings['gzip']):
+            return resp
+        data = resp.get_data()
+        if len(data) < COMPRESS_MIN_BYTES:
+            return resp
+        resp.set_data(gzip.compress(data, compresslevel=6))
+        resp.headers['Content-Encoding'] = 'gzip'
+        resp.vary.add('Accept-Encoding')
+        return resp
+
+if __name__ == '__main__':
+    static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    result = build(static_dir)
+    print(f"Built {len(result)} fingerprinted asset(s){'' if brotli else ' (brotli not installed, gzip only)'}.")
@@ -0,0 +1,83 @@
+"""
+Single-request avatar bundle for the kiosk roster (one per site).
+
+Instead of one /user_avatar/<id> request (and DB hit) per custom photo, the
+picker links one stylesheet that carries every stored photo as a data-URI
+background on an .avatar-u<id> class. Photos are already stored as data URIs,
+so building the bundle is string concatenation - no decoding or compositing.
+
+Only photos up to AVATAR_ATLAS_MAX_ENTRY characters (the kiosk's own
+uploads are resized to 256 px and come well under) are inlined; a larger
+photo's rule points at /user_avatar/<id> instead, so one big upload can't
+bloat the bundle and is only fetched by pages that show it. The page loads
+the bundle without blocking first paint.
+
+Entries are updated one at a time from upload_avatar/set_avatar/delete_user.
+The bundle URL carries a content hash so browsers cache it as immutable; each
+worker reloads the full set after AVATAR_ATLAS_TTL seconds to pick up changes
+made by other workers.
+"""
+import os
+import time
+import hashlib
+import threading
+from flask import url_for
+from sqlalchemy import func
+from models import db, Users
+import sites
+import db_routing
+
+_atlases = {}  # site id -> {'entries', 'loaded', 'css', 'version'}
+_lock = threading.Lock()
+
+def _ttl():
+    return int(os.environ.get('AVATAR_ATLAS_TTL', '300'))
+
+def _max_entry():
+    return int(os.environ.get('AVATAR_ATLAS_MAX_ENTRY', str(48 * 1024)))
+
+def _rule(user_id, data_uri):
+    """CSS rule for one user: the photo inline, or a link to it if it is too large (data_uri=None)."""
+    src = data_uri if data_uri is not None else url_for('main.user_avatar', user_id=user_id)
+    return f'.avatar-u{user_id}{{background-image:url("{src}")!important}}'
+
+def _load():
+    # Oversized photos are never read here - only whether one exists
+    small = func.length(Users.avatar_data) <= _max_entry()
+    rows = db.session.query(Users.user_id, db.case((small, Users.avatar_data), else_=None), db.case((small, 1), else_=0))\
+        .filter(Users.avatar_data.like('data:image/%')).all()
+    return {uid: _rule(uid, data if fits else None) for uid, data, fits in rows}
+
+def get():
+    """Returns (css, version) for the current site's bundle, rebuilding if needed."""
+    site_id = sites.current_id()
+    with _lock:
+        atlas = _atlases.setdefault(site_id, {'entries': None, 'loaded': 0.0, 'css': None, 'version': None})
+        fresh = atlas['entries'] is not None and time.monotonic() - atlas['loaded'] < _ttl()
+        if fresh and atlas['css'] is not None:
+            return atlas['css'], atlas['version']
+    if fresh:
+        entries = None
+    else:
+        with db_routing.use_primary():  # upload_avatar updates entries directly; a lagging replica would undo that
+            entries = _load()
+    with _lock:
+        if entries is not None:
+            atlas['entries'] = entries
+            atlas['loaded'] = time.monotonic()
+        css = '\n'.join(atlas['entries'][uid] for uid in sorted(atlas['entries']))
+        atlas['css'] = css
+        atlas['version'] = hashlib.sha256(css.encode()).hexdigest()[:12]
+        return atlas['css'], atlas['version']
+
+def update(user_id, data_uri):
+    """Replace (or with None, remove) one user's entry in the current site's bundle without reloading the rest."""
+    with _lock:
+        atlas = _atlases.get(sites.current_id())
+        if atlas is None or atlas['entries'] is None:
+            return  # nothing built yet; the next get() loads everything
+        if data_uri and data_uri.startswith('data:image/'):
+            atlas['entries'][user_id] = _rule(user_id, data_uri if len(data_uri) <= _max_entry() else None)
+        else:
+            atlas['entries'].pop(user_id, None)
+        atlas['css'] = None
@@ -0,0 +1,123 @@
+"""
+Cart mode: scan several items, pay once.
+
+With CART_MODE=1, product scans and Purchase taps go into a basket kept in
+the (signed cookie) session as {upc: quantity}, answered from a single
+product read with no write, commit or page render. Checkout - the Checkout
+button, logout, auto-logout, or the next user logging in at the kiosk - then
+records the whole basket in one transaction:
+
+  * one batched INSERT of every line item (one Transactions row per unit, so
+    history and undo work exactly as for single purchases),
+  * one balance update for the user,
+  * one stock decrement per SKU,
+  * one notification (a single email, or one digest line per SKU).
+
+Items that sold out while they sat in the basket are dropped and reported;
+the rest still go through.
+"""
+import os
+from datetime import datetime
+from decimal import Decimal
+from flask import session
+from models import db, Users, Products, Transactions
+import digests
+import history
+import sites
+
+MAX_LINES = 30
+MAX_QUANTITY = 20
+
+def enabled():
+    return os.environ.get('CART_MODE', '0') == '1'
+
+def _basket():
+    """The signed-in user's basket ({upc: qty}); a basket left by someone else is ignored."""
+    cart = session.get('cart')
+    if not cart or cart.get('user_id') != session.get('user_id'):
+        return {}
+    return dict(cart.get('items', {}))
+
+def _save(items):
+    if items:
+        session['cart'] = {'user_id': session.get('user_id'), 'items': items}
+    else:
+        session.pop('cart', None)
+
+def clear():
+    session.pop('cart', None)
+
+def summary(items=None):
+    """Basket lines with descriptions and prices, plus count and total, for the client."""
+    items = _basket() if items is None else items
+    products = {p.upc_code: p for p in Products.query.filter(Products.upc_code.in_(list(items))).all()} if items else {}
+    lines = [{'upc_code': upc, 'description': products[upc].description, 'price': float(products[upc].price or 0), 'quantity': qty}
+             for upc, qty in items.items() if upc in products]
+    return {'lines': lines, 'count': sum(l['quantity'] for l in lines),
+            'total': round(sum(l['price'] * l['quantity'] for l in lines), 2)}
+
+def add(upc):
+    """Put one of a product in the basket. Returns a status dict like process_barcode's."""
+    product = Products.query.filter_by(upc_code=upc).first()
+    if not product:
+        return {'status': 'not_found'}
+    items = _basket()
+    wanted = items.get(product.upc_code, 0) + 1
+    if product.stock_level is not None and product.stock_level < wanted:
+        return {'status': 'out_of_stock', 'description': product.description}
+    if wanted > MAX_QUANTITY or (product.upc_code not in items and len(items) >= MAX_LINES):
+        return {'status': 'cart_full', 'description': product.description}
+    items[product.upc_code] = wanted
+    _save(items)
+    return {'status': 'added', 'description': product.description, 'price': float(product.price or 0)}
+
+def remove(upc):
+    """Take one of a product out of the basket."""
+    items = _basket()
+    if upc in items:
+        items[upc] -= 1
+        if items[upc] <= 0:
+            del items[upc]
+        _save(items)
+
+def checkout():
+    """Commit the basket for the user who filled it (who may already have been signed out).
+
+    Returns {'status': 'empty'} or {'status': 'purchased', 'count', 'total', 'lines', 'skipped',
+    'user', 'mode'}; the caller sends the instant-mode email (see routes.send_purchase_email).
+    """
+    basket = session.get('cart') or {}
+    items, uid = dict(basket.get('items', {})), basket.get('user_id')
+    u = Users.query.get(int(uid)) if items and uid else None
+    if not u:
+        clear()
+        return {'status': 'empty'}
+    products = {p.upc_code: p for p in Products.query.filter(Products.upc_code.in_(list(items))).all()}
+    now = datetime.utcnow()
+    site_id = sites.current_id() or u.site_id
+    rows, lines, skipped, total = [], [], [], Decimal('0')
+    for upc, qty in items.items():
+        p = products.get(upc)
+        if not p or (p.stock_level is not None and p.stock_level < qty):
+            skipped.append(p.description if p else upc)
+            continue
+        price = Decimal(str(p.price or 0.0))
+        p.stock_level = (p.stock_level or 0) - qty
+        rows += [{'user_id': u.user_id, 'upc_code': upc, 'amount': price, 'transaction_date': now, 'site_id': site_id}] * qty
+        lines.append((p.description, qty, price))
+        total += price * qty
+    clear()
+    if not rows:
+        db.session.rollback()
+        return {'status': 'empty', 'skipped': skipped}
+    u.balance = Decimal(str(u.balance or 0.0)) - total
+    db.session.execute(db.insert(Transactions), rows)  # one executemany; bypasses the flush hooks
+    notify = bool(u.email and u.notify_on_purchase)
+    mode = digests.mode_for(u.user_id) if notify else None
+    if mode in ('visit', 'daily'):
+        for desc, qty, price in lines:
+            digests.buffer_purchase(u, f"{desc} x{qty}" if qty > 1 else desc, price * qty, u.balance)
+    db.session.commit()
+    history.invalidate(u.user_id)
+    return {'status': 'purchased', 'count': len(rows), 'total': float(total), 'skipped': skipped,
+            'lines': [(desc, qty, float(price)) for desc, qty, price in lines], 'user': u, 'mode': mode}
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Boot-time budget check, run in CI after the asset build.
+
+Imports the web app (app.py) and the job-only app (factory.create_app(web=False))
+in fresh interpreters and fails if either
+
+  * pulls in a module that is meant to load on first use (NumPy, requests,
+    smtplib/email, reports, forecast - and, for jobs, the web routes), or
+  * takes longer than IMPORT_BUDGET_MS (median of IMPORT_BUDGET_RUNS runs).
+
+Usage:
+    python check_imports.py
+"""
+import os
+import sys
+import json
+import statistics
+import subprocess
+
+DEFERRED = ['numpy', 'requests', 'smtplib', 'email.mime.multipart', 'reports', 'forecast']
+
+TARGETS = {
+    'web': ("import app", DEFERRED),
+    'jobs': ("import factory; factory.create_app(web=False)", DEFERRED + ['routes', 'assets']),
+}
+
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+{code}
+elapsed = (time.perf_counter() - start) * 1000
+print(json.dumps({{'ms': elapsed, 'loaded': [m for m in {watch!r} if m in sys.modules]}}))
+"""
+
+def measure(code, watch):
+    env = dict(os.environ, SCHEDULER_ENABLED='0')
+    env.setdefault('DATABASE_URI', 'sqlite://')  # no DB driver or server needed; nothing connects at import
+    out = subprocess.run([sys.executable, '-c', PROBE.format(code=code, watch=watch)], env=env,
+                         cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def main():
+    budget = float(os.environ.get('IMPORT_BUDGET_MS', '1500'))
+    runs = int(os.environ.get('IMPORT_BUDGET_RUNS', '3'))
+    ok = True
+    for name, (code, watch) in TARGETS.items():
+        results = [measure(code, watch) for _ in range(runs)]
+        median = statistics.median(r['ms'] for r in results)
+        loaded = sorted({m for r in results for m in r['loaded']})
+        print(f"{name}: {median:.0f} ms (budget {budget:.0f} ms)" + (f", eagerly imported: {', '.join(loaded)}" if loaded else ""))
+        ok = ok and median <= budget and not loaded
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
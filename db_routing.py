@@ -0,0 +1,156 @@
+"""
+Read-replica routing.
+
+When a 'replica' bind is configured (REPLICA_DATABASE_URI, or DB_REPLICA_HOST
+for an Azure SQL read-only replica), reads issued inside @read_replica views or
+a use_replica() block go to the replica engine; writes and flushes always go
+to the primary.
+
+Read-your-writes: any request that writes marks the browser session sticky for
+DB_STICKY_SECONDS, and sticky sessions skip the replica entirely, so a user
+who just bought something sees it in their next report/listing.
+
+Fallback: the replica is pinged at most every REPLICA_CHECK_SECONDS; while it
+is down everything uses the primary, and a @read_replica view that fails on
+the replica is retried once on the primary.
+
+Local testing with two SQLite files:
+    DATABASE_URI=sqlite:///primary.db REPLICA_DATABASE_URI=sqlite:///replica.db
+"""
+import os
+import time
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from flask import g, session, has_app_context, has_request_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, text
+from sqlalchemy.exc import DBAPIError
+
+REPLICA_BIND = 'replica'
+
+_health = {'ok': True, 'checked': 0.0}
+_health_lock = threading.Lock()
+
+def _setting(name, default):
+    return int(os.environ.get(name, default))
+
+def replica_uri():
+    """SQLAlchemy URI for the replica from the environment, or None if not configured."""
+    if os.environ.get('REPLICA_DATABASE_URI'):
+        return os.environ['REPLICA_DATABASE_URI']
+    host = os.environ.get('DB_REPLICA_HOST')
+    if not host:
+        return None
+    return (f"mssql+pyodbc://{os.environ.get('DB_USER')}:{os.environ.get('DB_PASS')}@{host}/"
+            f"{os.environ.get('DB_NAME')}?driver=ODBC+Driver+18+for+SQL+Server&ApplicationIntent=ReadOnly")
+
+def mark_replica_down():
+    with _health_lock:
+        _health['ok'], _health['checked'] = False, time.monotonic()
+
+def _replica_engine(db):
+    engine = db.engines.get(REPLICA_BIND)
+    if engine is None:
+        return None
+    now = time.monotonic()
+    with _health_lock:
+        due = now - _health['checked'] >= _setting('REPLICA_CHECK_SECONDS', '30')
+        if due:
+            _health['checked'] = now  # one pinger at a time; others use the last verdict
+    if due:
+        try:
+            with engine.connect() as conn:
+                conn.execute(text('SELECT 1'))
+            ok = True
+        except Exception:
+            ok = False
+        with _health_lock:
+            _health['ok'] = ok
+    return engine if _health['ok'] else None
+
+def _wants_replica():
+    return has_app_context() and g.get('_db_use_replica', False)
+
+class RoutingSession(Session):
+    """Flask-SQLAlchemy session that sends reads to the replica when asked to."""
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and _wants_replica() and not getattr(clause, 'is_dml', False):
+            engine = _replica_engine(self._db)
+            if engine is not None:
+                g._db_replica_used = True
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+@contextmanager
+def use_replica():
+    """Route reads in this block to the replica (if configured and healthy)."""
+    previous = g.get('_db_use_replica', False)
+    g._db_use_replica = True
+    try:
+        yield
+    finally:
+        g._db_use_replica = previous
+
+@contextmanager
+def use_primary():
+    """Read from the primary in this block, even inside a @read_replica view.
+
+    For per-worker caches keyed by a write version: a lagging replica would
+    store pre-write data under the post-write version and serve it to the
+    writer until the next write.
+    """
+    previous = g.get('_db_use_replica', False)
+    g._db_use_replica = False
+    try:
+        yield
+    finally:
+        g._db_use_replica = previous
+
+def is_sticky():
+    return has_request_context() and session.get('db_sticky_until', 0) > time.time()
+
+def read_replica(view):
+    """Serve this read-only view from the replica, unless the browser session just wrote."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if is_sticky():
+            return view(*args, **kwargs)
+        g._db_replica_used = False
+        try:
+            with use_replica():
+                return view(*args, **kwargs)
+        except DBAPIError:
+            if not g.get('_db_replica_used'):
+                raise
+            from models import db
+            db.session.rollback()
+            mark_replica_down()
+        return view(*args, **kwargs)
+    return wrapper
+
+def _note_write(*args, **kwargs):
+    if has_request_context():
+        g._db_wrote = True
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _after_flush(session_, flush_context):
+    if session_.new or session_.dirty or session_.deleted:
+        _note_write()
+
+event.listen(RoutingSession, 'after_bulk_update', _note_write)
+event.listen(RoutingSession, 'after_bulk_delete', _note_write)
+
+def init_app(app):
+    """Register the replica bind (if configured) and the read-your-writes hook."""
+    uri = replica_uri()
+    if uri:
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        binds[REPLICA_BIND] = uri
+        app.config['SQLALCHEMY_BINDS'] = binds
+
+    @app.after_request
+    def _mark_sticky(resp):
+        if g.get('_db_wrote'):
+            session['db_sticky_until'] = time.time() + _setting('DB_STICKY_SECONDS', '15')
+        return resp
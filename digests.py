@@ -0,0 +1,143 @@
+"""
+Coalesced purchase notifications.
+
+Users with notify_on_purchase pick a delivery mode (Notification_Prefs):
+
+  instant  one email per item, as before
+  visit    items are buffered and sent as one digest at logout, or once the
+           user has been quiet for DIGEST_QUIET_MINUTES
+  daily    items are buffered and sent as one digest at DIGEST_DAILY_TIME (NZ)
+
+Buffered items live in Notification_Outbox and are written in the same commit
+as the purchase. A flush claims rows by stamping a batch id with a single
+UPDATE ... WHERE Batch IS NULL, so two workers can never send the same item,
+and every digest in a flush goes out over one SMTP connection.
+"""
+import os
+import uuid
+import threading
+from datetime import datetime, timedelta
+from models import db, Users, NotificationPrefs, NotificationOutbox
+
+MODES = ('instant', 'visit', 'daily')
+MODE_LABELS = {'instant': 'Every purchase', 'visit': 'One email per visit', 'daily': 'Daily summary'}
+
+def mode_for(user_id):
+    prefs = NotificationPrefs.query.get(user_id)
+    return prefs.mode if prefs and prefs.mode in MODES else 'instant'
+
+def set_mode(user_id, mode):
+    """Stage the user's delivery mode on the session; caller commits."""
+    if mode not in MODES:
+        return
+    prefs = NotificationPrefs.query.get(user_id)
+    if prefs:
+        prefs.mode = mode
+    else:
+        db.session.add(NotificationPrefs(user_id=user_id, mode=mode))
+
+def buffer_purchase(user, description, price, new_balance):
+    """Stage one purchased item for a later digest; caller commits with the purchase."""
+    db.session.add(NotificationOutbox(user_id=user.user_id, description=description,
+                                      amount=price, balance_after=new_balance))
+
+def _claim(condition):
+    """Stamp a batch id on unclaimed outbox rows matching condition; return them grouped by user."""
+    batch = uuid.uuid4().hex
+    claimed = NotificationOutbox.query.filter(NotificationOutbox.batch.is_(None), condition)\
+        .update({NotificationOutbox.batch: batch}, synchronize_session=False)
+    db.session.commit()
+    if not claimed:
+        return {}
+    grouped = {}
+    for row in NotificationOutbox.query.filter_by(batch=batch)\
+            .order_by(NotificationOutbox.user_id, NotificationOutbox.created_at).all():
+        grouped.setdefault(row.user_id, []).append(row)
+    return grouped
+
+def _digest_message(smtp_from, user, rows):
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
+    display = user.screen_name or user.first_name
+    total = sum(float(r.amount or 0) for r in rows)
+    lines = "\n".join(f"  {r.created_at.strftime('%H:%M') if r.created_at else '':>5}  {r.description}  ${float(r.amount or 0):.2f}" for r in rows)
+    msg = MIMEMultipart('alternative')
+    msg['Subject'] = f"Snackshack: {len(rows)} purchase{'s' if len(rows) != 1 else ''} (${total:.2f})"
+    msg['From'] = smtp_from
+    msg['To'] = user.email
+    body = f"""Hi {display},
+
+These purchases were recorded on your Snackshack account:
+
+{lines}
+
+  Total: ${total:.2f}
+  Balance: ${float(rows[-1].balance_after or 0):.2f}
+
+If this wasn't you, please speak to an admin.
+
+- Claudes Snackshack"""
+    msg.attach(MIMEText(body, 'plain'))
+    return msg
+
+def _send(grouped):
+    """Send one digest per user over a single SMTP session. Returns the number sent."""
+    if not grouped:
+        return 0
+    import smtplib
+    smtp_host = os.environ.get('SMTP_HOST', 'mail.smtp2go.com')
+    smtp_port = int(os.environ.get('SMTP_PORT', 2525))
+    smtp_user = os.environ.get('SMTP_USER', '')
+    smtp_pass = os.environ.get('SMTP_PASS', '')
+    smtp_from = os.environ.get('SMTP_FROM', smtp_user)
+    users = {u.user_id: u for u in Users.query.filter(Users.user_id.in_(list(grouped))).all()}
+    sent = 0
+    if smtp_user and smtp_pass:
+        try:
+            with smtplib.SMTP(smtp_host, smtp_port) as server:
+                server.starttls()
+                server.login(smtp_user, smtp_pass)
+                for uid, rows in grouped.items():
+                    u = users.get(uid)
+                    if u and u.email and u.notify_on_purchase:
+                        server.sendmail(smtp_from, u.email, _digest_message(smtp_from, u, rows).as_string())
+                        sent += 1
+        except Exception:
+            pass  # Don't retry - a digest is a courtesy, like the per-item email
+    ids = [r.outbox_id for rows in grouped.values() for r in rows]
+    NotificationOutbox.query.filter(NotificationOutbox.outbox_id.in_(ids))\
+        .update({NotificationOutbox.sent_at: datetime.utcnow()}, synchronize_session=False)
+    db.session.commit()
+    return sent
+
+def flush_user(app, user_id):
+    """Send a user's buffered per-visit items now (at logout), in a background thread."""
+    def _run():
+        with app.app_context():
+            try:
+                visit_users = db.session.query(NotificationPrefs.user_id).filter_by(user_id=user_id, mode='visit')
+                _send(_claim(NotificationOutbox.user_id.in_(visit_users)))
+            finally:
+                db.session.remove()
+    threading.Thread(target=_run, daemon=True).start()
+
+def flush_quiet(app):
+    """Scheduler job: digests for non-daily users idle for DIGEST_QUIET_MINUTES."""
+    with app.app_context():
+        quiet = int(os.environ.get('DIGEST_QUIET_MINUTES', '10'))
+        cutoff = datetime.utcnow() - timedelta(minutes=quiet)
+        # users with buffered items whose newest item is older than the quiet window
+        recent = db.session.query(NotificationOutbox.user_id)\
+            .filter(NotificationOutbox.batch.is_(None), NotificationOutbox.created_at >= cutoff)
+        # everyone not on daily digests, so items buffered before a switch to instant still go out
+        daily_users = db.session.query(NotificationPrefs.user_id).filter_by(mode='daily')
+        _send(_claim(db.and_(NotificationOutbox.user_id.notin_(daily_users),
+                             NotificationOutbox.user_id.notin_(recent))))
+        return True
+
+def flush_daily(app):
+    """Scheduler job: everything buffered for daily-digest users."""
+    with app.app_context():
+        daily_users = db.session.query(NotificationPrefs.user_id).filter_by(mode='daily')
+        _send(_claim(NotificationOutbox.user_id.in_(daily_users)))
+        return True
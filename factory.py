@@ -0,0 +1,51 @@
+"""
+Application factory.
+
+create_app() builds the Flask app; app.py calls it for the web workers and
+jobs.py calls it with web=False for scheduled jobs run from the command line
+(no routes, static handling or scheduler thread). Integration code - SMS,
+SMTP, OpenFoodFacts, reports and forecasting (NumPy) - is imported on first
+use rather than at boot; check_imports.py keeps it that way.
+"""
+import os
+from datetime import timedelta
+from flask import Flask
+from models import db
+import db_routing
+import sites
+import jobs
+
+def create_app(web=True):
+    app = Flask(__name__)
+
+    # Use Environment Variable for security in Azure
+    app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'dev-key-default-123')
+
+    # Database Connection Logic
+    db_user = os.environ.get('DB_USER')
+    db_pass = os.environ.get('DB_PASS')
+    db_host = os.environ.get('DB_HOST')
+    db_name = os.environ.get('DB_NAME')
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URI') or f"mssql+pyodbc://{db_user}:{db_pass}@{db_host}/{db_name}?driver=ODBC+Driver+18+for+SQL+Server"
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['MAX_CONTENT_LENGTH'] = 20 * 1024 * 1024  # 20 MB ceiling; individual routes enforce tighter limits
+    app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=30)
+
+    db_routing.init_app(app)  # optional read replica (REPLICA_DATABASE_URI / DB_REPLICA_HOST)
+    db.init_app(app)
+    jobs.register_all()
+    sites.init_templates(app)  # current_site for pages and for reports rendered by jobs
+    if not web:
+        return app
+
+    from routes import main
+    import assets
+    import scheduler
+    import lanes
+    lanes.init_app(app)  # per-class concurrency limits; registered first so shed requests touch nothing else
+    app.register_blueprint(main)
+    sites.init_app(app)  # per-site scoping by kiosk token or hostname (SNACKSHACK_SITES)
+    assets.init_app(app)  # fingerprinted static URLs + gzip/brotli (build with `python assets.py`)
+    scheduler.start(app)  # nightly report etc.; one leader across workers via the Job_Leases row
+    return app
@@ -0,0 +1,148 @@
+"""
+Sales velocity and reorder forecasting.
+
+All purchase history is pulled in one query and turned into a
+products x days unit-count matrix with a single np.bincount; velocity,
+weekday seasonality and days-of-stock-remaining are then array operations
+over that matrix - no per-product or per-transaction Python loops.
+
+  velocity      mean units/day over the last FORECAST_WINDOW_DAYS (or since
+                the product's first sale, if newer)
+  weekday       per-weekday demand index from the full history, shrunk
+                towards 1.0 for products with few sales
+  days_left     days until cumulative forecast demand exceeds stock on hand
+  suggested_qty units to cover REORDER_LEAD_DAYS + REORDER_COVER_DAYS when
+                days_left falls inside the lead time
+
+Results are cached per site until the next purchase, undo or stock change
+in this worker; FORECAST_CACHE_TTL bounds staleness from other workers.
+"""
+import os
+import math
+import time
+import threading
+from datetime import datetime
+import numpy as np
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models import db, Products, Transactions
+import sites
+import db_routing
+
+HORIZON_DAYS = 120
+SHRINK_UNITS = 20  # sales needed before a product's own weekday pattern gets half weight
+
+_cache = {'version': 0, 'results': {}}  # results: site id -> (key, computed at, forecast)
+_lock = threading.Lock()
+
+def _setting(name, default):
+    return int(os.environ.get(name, default))
+
+@event.listens_for(Session, 'after_flush')
+def _invalidate_on_flush(session, flush_context):
+    for obj in list(session.new) + list(session.deleted) + list(session.dirty):
+        if isinstance(obj, (Transactions, Products)):
+            with _lock:
+                _cache['version'] += 1
+            return
+
+def invalidate():
+    with _lock:
+        _cache['version'] += 1
+
+def compute(today=None):
+    """Forecast for every product. Returns {upc: {...}} (products with no sales included)."""
+    today = today or datetime.utcnow().date()
+    window = _setting('FORECAST_WINDOW_DAYS', '28')
+    lead = _setting('REORDER_LEAD_DAYS', '7')
+    cover = _setting('REORDER_COVER_DAYS', '14')
+
+    products = db.session.query(Products.upc_code, Products.stock_level).all()
+    upcs = np.array([p[0] for p in products], dtype=object)
+    stock = np.array([p[1] or 0 for p in products], dtype=np.float64)
+    n = len(upcs)
+    if n == 0:
+        return {}
+    position = {upc: i for i, upc in enumerate(upcs)}
+
+    sales = db.session.query(Transactions.upc_code, Transactions.transaction_date)\
+        .filter(Transactions.amount > 0, Transactions.transaction_date.isnot(None)).all()
+    pidx = np.array([position.get(s[0], -1) for s in sales], dtype=np.int64)
+    dates = np.array([s[1] for s in sales], dtype='datetime64[D]')
+    keep = pidx >= 0
+    pidx, dates = pidx[keep], dates[keep]
+
+    today64 = np.datetime64(today, 'D')
+    start = dates.min() if len(dates) else today64
+    n_days = int((today64 - start).astype(int)) + 1
+    didx = np.clip((dates - start).astype(np.int64), 0, n_days - 1)
+    counts = np.bincount(pidx * n_days + didx, minlength=n * n_days).reshape(n, n_days).astype(np.float64)
+
+    # Velocity over the recent window, shortened for products first sold inside it
+    sold_any = counts.sum(axis=1) > 0
+    first_day = np.where(sold_any, (counts > 0).argmax(axis=1), n_days - 1)
+    recent_from = max(n_days - window, 0)
+    effective = np.minimum(window, n_days - np.maximum(first_day, recent_from)).clip(min=1)
+    velocity = counts[:, recent_from:].sum(axis=1) / effective
+
+    # Weekday index from the full history: per-weekday rate / overall rate, shrunk towards 1
+    start_weekday = (int(start.astype(np.int64)) + 3) % 7  # day 0 of datetime64 (1970-01-01) was a Thursday
+    day_weekday = (np.arange(n_days) + start_weekday) % 7     # 0 = Monday, like date.weekday()
+    weekday_totals = np.stack([counts[:, day_weekday == w].sum(axis=1) for w in range(7)], axis=1)
+    weekday_days = np.array([(day_weekday == w).sum() for w in range(7)], dtype=np.float64).clip(min=1)
+    total_units = counts.sum(axis=1)
+    overall_rate = total_units / n_days
+    with np.errstate(divide='ignore', invalid='ignore'):
+        raw_index = np.where(overall_rate[:, None] > 0, (weekday_totals / weekday_days) / overall_rate[:, None], 1.0)
+    weight = (total_units / (total_units + SHRINK_UNITS))[:, None]
+    weekday_index = weight * raw_index + (1 - weight) * 1.0
+
+    # Walk forward HORIZON_DAYS: expected demand per future day, cumulated
+    future_weekday = (today.weekday() + 1 + np.arange(HORIZON_DAYS)) % 7
+    demand = velocity[:, None] * weekday_index[:, future_weekday]
+    cumulative = demand.cumsum(axis=1)
+    covered = cumulative >= np.maximum(stock, 0)[:, None]
+    reached = covered.any(axis=1)
+    days_left = np.where(stock <= 0, 0, np.where(reached, covered.argmax(axis=1), np.inf))
+    days_left = np.where(velocity > 0, days_left, np.inf)
+
+    need = cumulative[:, min(lead + cover, HORIZON_DAYS) - 1] - stock
+    reorder = (velocity > 0) & (days_left <= lead)
+    suggested = np.where(reorder, np.ceil(np.maximum(need, 1)), 0).astype(int)
+
+    return {
+        upcs[i]: {
+            'velocity': round(float(velocity[i]), 2),
+            'weekday_index': [round(float(x), 2) for x in weekday_index[i]],
+            'days_left': None if math.isinf(days_left[i]) else int(days_left[i]),
+            'reorder': bool(reorder[i]),
+            'suggested_qty': int(suggested[i]),
+        } for i in range(n)
+    }
+
+def get_forecast():
+    """Cached compute() - recomputed after any purchase/stock change, on a new day or after FORECAST_CACHE_TTL."""
+    today = datetime.utcnow().date()
+    site_id = sites.current_id()
+    with _lock:
+        key = (_cache['version'], today)
+        hit = _cache['results'].get(site_id)
+        if hit and hit[0] == key and time.monotonic() - hit[1] < _setting('FORECAST_CACHE_TTL', '300'):
+            return hit[2]
+    with db_routing.use_primary():
+        result = compute(today)
+    with _lock:
+        _cache['results'][site_id] = (key, time.monotonic(), result)
+    return result
+
+def reorder_list():
+    """Products due for reorder as dicts, soonest stock-out first."""
+    forecast = get_forecast()
+    due = [upc for upc, f in forecast.items() if f['reorder']]
+    if not due:
+        return []
+    rows = db.session.query(Products.upc_code, Products.description, Products.category, Products.stock_level)\
+        .filter(Products.upc_code.in_(due)).all()
+    items = [{'upc_code': upc, 'description': desc or upc, 'category': cat or '', 'stock_level': soh or 0, **forecast[upc]}
+             for upc, desc, cat, soh in rows]
+    return sorted(items, key=lambda r: (r['days_left'], -r['velocity']))
@@ -0,0 +1,95 @@
+"""
+Rendered-HTML cache for the kiosk user picker and product grid.
+
+The two big loops in index.html only change when a user or product row
+changes, so they are rendered once and reused until a version counter is
+bumped. The counters are bumped automatically from a SQLAlchemy flush hook
+whenever a column that the fragments display is written.
+
+Each gunicorn worker keeps its own cache, so FRAGMENT_CACHE_TTL (seconds)
+bounds how long a worker can serve a fragment after another worker wrote.
+"""
+import os
+import threading
+import time
+from flask import render_template
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from models import db, Users, Products
+import sites
+
+CATEGORY_ORDER = ["Drinks", "Snacks", "Candy", "Frozen", "Coffee Pods", "Sweepstake Tickets"]
+
+# Columns shown in each fragment - writes to anything else (balance, last_seen, ...) don't invalidate
+_USER_GRID_FIELDS = {'first_name', 'last_name', 'screen_name', 'avatar', 'avatar_data', 'pin', 'is_admin', 'is_super_admin'}
+_PRODUCT_GRID_FIELDS = {'upc_code', 'description', 'price', 'stock_level', 'is_quick_item', 'category'}
+
+_versions = {'users': 0, 'products': 0}
+_fragments = {}
+_lock = threading.Lock()
+
+def ttl():
+    return int(os.environ.get('FRAGMENT_CACHE_TTL', '60'))
+
+def bump(kind):
+    """Invalidate the cached fragments for 'users' or 'products'."""
+    with _lock:
+        _versions[kind] += 1
+
+def version(kind):
+    """Current version counter for 'users' or 'products' (for other per-worker caches)."""
+    with _lock:
+        return _versions[kind]
+
+def _touches(obj, fields):
+    state = inspect(obj)
+    return any(state.attrs[f].history.has_changes() for f in fields)
+
+@event.listens_for(Session, 'after_flush')
+def _invalidate_on_flush(session, flush_context):
+    users = products = False
+    for obj in list(session.new) + list(session.deleted):
+        users = users or isinstance(obj, Users)
+        products = products or isinstance(obj, Products)
+    for obj in session.dirty:
+        if not users and isinstance(obj, Users) and _touches(obj, _USER_GRID_FIELDS):
+            users = True
+        elif not products and isinstance(obj, Products) and _touches(obj, _PRODUCT_GRID_FIELDS):
+            products = True
+    if users:
+        bump('users')
+    if products:
+        bump('products')
+
+def _cached(key, kind, build):
+    key = (sites.current_id(),) + key  # fragments are per site
+    now = time.monotonic()
+    with _lock:
+        version = _versions[kind]
+        hit = _fragments.get(key)
+    if hit and hit[0] == version and now - hit[1] < ttl():
+        return hit[2]
+    value = build()
+    with _lock:
+        _fragments[key] = (version, now, value)
+    return value
+
+def user_grid_html(is_mobile):
+    """Rendered user tiles for the kiosk (or mobile) picker."""
+    def build():
+        # Alphabetical sorting for 80+ names - prefer screen_name, fallback to first_name
+        users = Users.query.order_by(
+            db.func.coalesce(Users.screen_name, Users.first_name).asc()
+        ).all()
+        return render_template('_user_grid.html', users=users, is_mobile=is_mobile)
+    return _cached(('users', bool(is_mobile)), 'users', build)
+
+def product_grid():
+    """Returns (category names, rendered product grid HTML) for the quick items."""
+    def build():
+        grouped = {cat: [] for cat in CATEGORY_ORDER}
+        for p in Products.query.filter_by(is_quick_item=True).all():
+            grouped.setdefault(p.category or "Snacks", []).append(p)
+        grouped = {k: v for k, v in grouped.items() if v}
+        return list(grouped), render_template('_product_grid.html', grouped_products=grouped)
+    return _cached(('products',), 'products', build)
@@ -0,0 +1,12 @@
+"""
+Gunicorn settings, read automatically from the app directory (the Azure
+startup command's own flags still win).
+
+Threaded workers let lanes.py give reports, images and admin pages a bounded
+share of each worker while purchases use whatever threads are left; with
+sync workers a single slow report would hold the whole worker.
+"""
+import os
+
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', '12'))  # keep above the sum of every lane's LIMIT + QUEUE (9 by default)
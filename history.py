@@ -0,0 +1,170 @@
+"""
+Personal purchase history.
+
+Pages run newest first with a keyset on (Transaction_Date, Transaction_ID),
+backed by ix_Transactions_User_Date (built on existing databases by
+`python jobs.py migrate`), so page N costs the same as page 1.
+
+Per-month subtotals for closed months are cached per user (they only change
+when an admin deletes history) and dropped by a flush hook whenever one of
+that user's transactions is written or deleted; the current month is always
+summed live. HISTORY_CACHE_TTL bounds staleness across workers.
+
+Purchases can be undone by the user for UNDO_WINDOW_MINUTES, several at a
+time, in one commit that refunds the balance, restocks each product and
+takes the items back out of any digest that hasn't been sent yet.
+"""
+import os
+import time
+import base64
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import event, and_, or_, func, extract
+from sqlalchemy.orm import Session
+from models import db, Users, Products, Transactions, NotificationOutbox
+
+MAX_PAGE = 100
+MAX_UNDO = 50
+OUTBOX_MATCH = timedelta(seconds=5)  # outbox rows are written in the purchase's commit
+
+_months = {}  # user id -> (loaded at, closed-month rows)
+_lock = threading.Lock()
+
+def _ttl():
+    return int(os.environ.get('HISTORY_CACHE_TTL', '600'))
+
+def undo_window():
+    return timedelta(minutes=int(os.environ.get('UNDO_WINDOW_MINUTES', '15')))
+
+@event.listens_for(Session, 'after_flush')
+def _invalidate_on_flush(session, flush_context):
+    for obj in list(session.new) + list(session.deleted) + list(session.dirty):
+        if isinstance(obj, Transactions):
+            invalidate(obj.user_id)
+
+def invalidate(user_id=None):
+    """Drop cached subtotals for one user, or everyone (for bulk deletes)."""
+    with _lock:
+        if user_id is None:
+            _months.clear()
+        else:
+            _months.pop(user_id, None)
+
+def encode_cursor(when, transaction_id):
+    return base64.urlsafe_b64encode(f"{when.isoformat()}|{transaction_id}".encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """(datetime, transaction id) from encode_cursor, or None for missing or malformed cursors."""
+    if not cursor:
+        return None
+    try:
+        when, tid = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode().split('|')
+        return datetime.fromisoformat(when), int(tid)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+def page(user_id, limit=25, after=None):
+    """One page of a user's transactions, newest first. Returns (items, next_cursor)."""
+    limit = max(1, min(int(limit), MAX_PAGE))
+    q = db.session.query(Transactions.transaction_id, Transactions.transaction_date, Transactions.amount,
+                         Transactions.upc_code, Products.description)\
+        .outerjoin(Products, and_(Products.site_id == Transactions.site_id, Products.upc_code == Transactions.upc_code))\
+        .filter(Transactions.user_id == user_id, Transactions.transaction_date.isnot(None))
+    key = decode_cursor(after)
+    if key:
+        when, tid = key
+        q = q.filter(or_(Transactions.transaction_date < when,
+                         and_(Transactions.transaction_date == when, Transactions.transaction_id < tid)))
+    rows = q.order_by(Transactions.transaction_date.desc(), Transactions.transaction_id.desc()).limit(limit + 1).all()
+    cutoff = datetime.utcnow() - undo_window()
+    items = [{
+        'id': tid,
+        'date': when.isoformat() + 'Z',
+        'description': desc or ('Payment' if (amount or 0) < 0 else upc),
+        'amount': float(amount or 0),
+        'undoable': (amount or 0) > 0 and when >= cutoff,
+    } for tid, when, amount, upc, desc in rows[:limit]]
+    next_cursor = encode_cursor(rows[limit - 1][1], rows[limit - 1][0]) if len(rows) > limit else None
+    return items, next_cursor
+
+def _month_rows(user_id, start=None, end=None):
+    year = extract('year', Transactions.transaction_date)
+    month = extract('month', Transactions.transaction_date)
+    q = db.session.query(year, month,
+                         func.sum(db.case((Transactions.amount > 0, Transactions.amount), else_=0)),
+                         func.sum(db.case((Transactions.amount < 0, -Transactions.amount), else_=0)),
+                         func.count(Transactions.transaction_id))\
+        .filter(Transactions.user_id == user_id)
+    if start:
+        q = q.filter(Transactions.transaction_date >= start)
+    if end:
+        q = q.filter(Transactions.transaction_date < end)
+    return [{'month': f"{int(y):04d}-{int(m):02d}", 'spent': float(spent or 0), 'paid': float(paid or 0), 'count': n}
+            for y, m, spent, paid, n in q.group_by(year, month).all()]
+
+def month_totals(user_id):
+    """Per-month {'month', 'spent', 'paid', 'count'} for a user, newest first."""
+    month_start = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    with _lock:
+        hit = _months.get(user_id)
+    if hit and time.monotonic() - hit[0] < _ttl():
+        closed = hit[1]
+    else:
+        closed = _month_rows(user_id, end=month_start)
+        with _lock:
+            _months[user_id] = (time.monotonic(), closed)
+    rows = _month_rows(user_id, start=month_start) + closed
+    return sorted(rows, key=lambda r: r['month'], reverse=True)
+
+def unbuffer(t, description):
+    """Take an undone purchase out of the user's unsent digest, if it is waiting in one; caller commits.
+
+    Outbox rows don't reference transactions, so the row is found by user, time and
+    description; a cart line ("Coke x3") loses one unit instead.
+    """
+    if not description:
+        return
+    rows = NotificationOutbox.query.filter(
+        NotificationOutbox.user_id == t.user_id, NotificationOutbox.batch.is_(None),
+        NotificationOutbox.created_at.between(t.transaction_date - OUTBOX_MATCH, t.transaction_date + OUTBOX_MATCH),
+        or_(NotificationOutbox.description == description, NotificationOutbox.description.like(f"{description} x%")))\
+        .order_by(NotificationOutbox.outbox_id).all()
+    for row in rows:
+        if row.description == description and row.amount == t.amount:
+            db.session.delete(row)
+            return
+    for row in rows:
+        qty = row.description[len(description) + 2:]
+        if qty.isdigit():
+            qty = int(qty) - 1
+            row.description = f"{description} x{qty}" if qty > 1 else description
+            row.amount = (row.amount or 0) - t.amount
+            return
+
+def undo(user_id, transaction_ids):
+    """Reverse the user's own purchases among transaction_ids that are inside the undo window.
+
+    Refunds the balance, restocks each product and drops the items from any unsent digest,
+    in one commit. Returns (count, amount refunded).
+    """
+    ids = [int(i) for i in transaction_ids][:MAX_UNDO]
+    if not ids:
+        return 0, 0.0
+    cutoff = datetime.utcnow() - undo_window()
+    txs = Transactions.query.filter(Transactions.transaction_id.in_(ids), Transactions.user_id == user_id,
+                                    Transactions.amount > 0, Transactions.transaction_date >= cutoff).all()
+    if not txs:
+        return 0, 0.0
+    u = Users.query.get(user_id)
+    products = {p.upc_code: p for p in Products.query.filter(Products.upc_code.in_({t.upc_code for t in txs})).all()}
+    refunded = 0
+    for t in txs:
+        refunded += t.amount
+        p = products.get(t.upc_code)
+        if p:
+            p.stock_level = (p.stock_level or 0) + 1
+        db.session.delete(t)
+        unbuffer(t, p.description if p else None)
+    u.balance = (u.balance or 0) + refunded
+    db.session.commit()
+    return len(txs), float(refunded)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Scheduled jobs and a command line to run them.
+
+register_all() is called by factory.create_app(); job functions are named as
+'module:function' so their modules (SMTP, reports, NumPy) load on first run.
+
+The command line builds the app without web routes or the scheduler thread:
+
+    python jobs.py list                     registered jobs and recent runs
+    python jobs.py run nightly_report       run today's slot (skipped if already run)
+    python jobs.py run nightly_report --force    run now in a fresh manual slot
+    python jobs.py migrate                  bring an existing database up to models.py
+
+Runs claim the same Job_Runs slots as the in-app scheduler, so a cron or
+WebJob invocation never double-runs a job. Exit status is non-zero unless the
+job ran ('ok') or was already done ('skipped').
+
+migrate runs at deploy: the workflow sets the App Service startup command to
+startup.sh, which runs it before starting gunicorn, so every deploy (and every
+restart) upgrades the schema first. It alters tables and builds indexes that
+scan them, which must not happen inside a kiosk request; web workers only
+check that it has run (sites.check_schema). Instances starting together take
+turns through an application lock. Run it by hand (or as a triggered WebJob)
+against a database before pointing an older deployment at it.
+"""
+import os
+import sys
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import scheduler
+
+def register_all():
+    """Register every periodic job (idempotent)."""
+    scheduler.register('nightly_report', 'reports:send_nightly_report',
+                       daily_at=os.environ.get('NIGHTLY_REPORT_TIME', '21:00'))
+    scheduler.register('digest_quiet_flush', 'digests:flush_quiet', every=timedelta(minutes=5))
+    scheduler.register('digest_daily_flush', 'digests:flush_daily',
+                       daily_at=os.environ.get('DIGEST_DAILY_TIME', '20:00'))
+
+# every model, in foreign-key order; migrate creates any table that is missing
+# (the ones added since the original schema, or all of them on a new database)
+TABLES = ['Users', 'Products', 'Wallpapers', 'Transactions',
+          'JobLeases', 'JobRuns', 'NotificationPrefs', 'NotificationOutbox']
+
+# models whose tables predate multi-site support and need Site_ID added
+SITE_SCOPED = ['Users', 'Products', 'Transactions', 'Wallpapers']
+
+# (model, index name) declared in models.py that existing databases may lack
+INDEXES = [
+    ('Transactions', 'ix_Transactions_User_Date'),
+]
+
+@contextmanager
+def _migration_lock(db):
+    """Hold a SQL Server application lock so instances starting together migrate one at a time."""
+    if db.engine.dialect.name != 'mssql':
+        yield
+        return
+    with db.engine.connect() as conn:
+        conn.execute(db.text("EXEC sp_getapplock @Resource = 'snackshack-migrate', @LockMode = 'Exclusive', "
+                             "@LockOwner = 'Session', @LockTimeout = 600000"))
+        try:
+            yield
+        finally:
+            conn.execute(db.text("EXEC sp_releaseapplock @Resource = 'snackshack-migrate', @LockOwner = 'Session'"))
+
+def migrate(app):
+    """Create missing TABLES, add missing Site_ID columns and per-site keys, then any missing INDEXES
+    (idempotent). Returns what changed."""
+    import models
+    with app.app_context(), _migration_lock(models.db):
+        changed = models.ensure_tables(*(getattr(models, m) for m in TABLES))
+        changed += [f"{name}.Site_ID" for name in models.ensure_site_columns(*(getattr(models, m) for m in SITE_SCOPED))]
+        changed += models.ensure_site_keys()
+        changed += [name for model, name in INDEXES if models.ensure_index(getattr(models, model), name)]
+        return changed
+
+def run(app, name, force=False):
+    """Run job name for its current slot (today's, for daily jobs). Returns the run_job() status."""
+    job = scheduler.get_job(name)
+    now = datetime.utcnow()
+    if force:
+        slot = f"manual-{now.strftime('%Y-%m-%dT%H:%M')}"
+    elif job.every:
+        slot = job.current_slot(now)
+    else:
+        slot = job.day_slot(now)
+    with app.app_context():
+        return scheduler.run_job(app, name, slot)
+
+def main(argv):
+    import argparse
+    from factory import create_app
+
+    parser = argparse.ArgumentParser(prog='jobs.py', description="Run Snackshack scheduled jobs.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('list', help="show registered jobs and recent runs")
+    run_parser = sub.add_parser('run', help="run one job")
+    run_parser.add_argument('name')
+    run_parser.add_argument('--force', action='store_true', help="run even if today's slot was already claimed")
+    sub.add_parser('migrate', help="create tables, columns, keys and indexes missing from the database (startup.sh runs it)")
+    args = parser.parse_args(argv)
+
+    app = create_app(web=False)
+    if args.command == 'list':
+        for name, job in sorted(scheduler.all_jobs().items()):
+            when = f"daily at {job.daily_at}" if job.daily_at else f"every {job.every}"
+            print(f"{name:<22} {when}")
+        with app.app_context():
+            for r in scheduler.recent_runs(10):
+                print(f"  {r.started_at:%Y-%m-%d %H:%M}  {r.job_name:<22} {r.slot:<22} {r.status}")
+        return 0
+    if args.command == 'migrate':
+        changed = migrate(app)
+        print(f"migrated: {', '.join(changed)}" if changed else "schema up to date")
+        return 0
+    if args.name not in scheduler.all_jobs():
+        parser.error(f"unknown job {args.name!r}")
+    status = run(app, args.name, force=args.force)
+    print(f"{args.name}: {status}")
+    return 0 if status in ('ok', 'skipped') else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,170 @@
+"""
+Request classes with their own concurrency limits, so slow traffic can't take
+every worker thread away from the kiosk.
+
+Each request is put in one lane by endpoint:
+
+  purchase  scans, cart, login/logout, the kiosk page - never limited
+  admin     interactive /admin pages and APIs (including the OpenFoodFacts lookup)
+  bulk      reports, nightly report sends and previews, chunked deletes
+  static    product images, wallpapers, avatars (and static files, which are
+            counted here but never limited or shed - the page needs its CSS/JS)
+
+Limited lanes hold a per-worker semaphore (LANE_<NAME>_LIMIT slots) for the
+length of the request. At most LANE_<NAME>_QUEUE more requests may wait for
+a slot, each for up to LANE_<NAME>_WAIT_MS; a request beyond that queue, or
+one whose wait runs out, gets a 503 with Retry-After instead of tying up a
+thread. Bulk and image requests are also shed while LANE_PRESSURE actual
+purchases (scan, manual add, cart, sign-in) are in flight.
+
+A lane can therefore occupy at most LIMIT + QUEUE threads, and purchases
+always find a free one as long as those add up to fewer than the worker's
+threads (see gunicorn.conf.py).
+
+Queue wait, service time and shed counts are kept per lane (per worker) for
+/admin/lanes, and every response carries a Server-Timing entry with its
+lane and queue wait.
+"""
+import os
+import time
+import threading
+from collections import deque
+from flask import g, request, jsonify
+
+LANES = ('purchase', 'admin', 'bulk', 'static')
+SHEDDABLE = ('bulk', 'static')
+
+_DEFAULTS = {  # lane: (limit, queue, wait ms); a limit of 0 means unlimited
+    'purchase': (0, 0, 0),
+    'admin': (3, 2, 10000),
+    'bulk': (1, 0, 0),
+    'static': (2, 1, 500),
+}
+
+_BULK_ENDPOINTS = {
+    'main.monthly_report', 'main.trigger_nightly_report', 'main.preview_nightly_report',
+    'main.nuke_transactions', 'main.reset_balances', 'main.purge_users', 'main.delete_user',
+}
+_STATIC_ENDPOINTS = {
+    'static', 'main.product_image', 'main.wallpaper_image', 'main.user_avatar', 'main.avatar_atlas_css',
+}
+_PURCHASE_ENDPOINTS = {  # what LANE_PRESSURE counts - not page loads or the type-ahead
+    'main.scan', 'main.manual_add', 'main.cart_add', 'main.cart_remove', 'main.cart_checkout',
+    'main.pin_verify', 'main.select_user', 'main.undo',
+}
+
+_lock = threading.Lock()
+_slots = {}  # lane -> BoundedSemaphore (limited lanes only)
+_waiting = {lane: 0 for lane in LANES}
+_purchases = {'active': 0}
+_stats = {lane: {'requests': 0, 'shed': 0, 'active': 0, 'peak': 0,
+                 'waits': deque(maxlen=500), 'service': deque(maxlen=500)} for lane in LANES}
+
+def _setting(lane, key):
+    default = dict(zip(('LIMIT', 'QUEUE', 'WAIT_MS'), _DEFAULTS[lane]))[key]
+    return int(os.environ.get(f"LANE_{lane.upper()}_{key}", str(default)))
+
+def _semaphore(lane):
+    with _lock:
+        if lane not in _slots:
+            limit = _setting(lane, 'LIMIT')
+            _slots[lane] = threading.BoundedSemaphore(limit) if limit > 0 else None
+        return _slots[lane]
+
+def classify():
+    """Lane for the current request."""
+    endpoint = request.endpoint
+    if endpoint is None or endpoint in _STATIC_ENDPOINTS:
+        return 'static'
+    if endpoint in _BULK_ENDPOINTS:
+        return 'bulk'
+    if request.url_rule is not None and request.url_rule.rule.startswith('/admin'):
+        return 'admin'
+    return 'purchase'
+
+def _shed(lane):
+    with _lock:
+        _stats[lane]['shed'] += 1
+    resp = jsonify({"error": "busy, please retry", "lane": lane}) if '/api/' in request.path \
+        else "The Snackshack is busy right now - please try again in a moment."
+    return resp, 503, {'Retry-After': os.environ.get('LANE_RETRY_AFTER', '5')}
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))], 1)
+
+def stats():
+    """Per-lane counters and queue/service time percentiles for this worker."""
+    with _lock:
+        out = {}
+        for lane, s in _stats.items():
+            out[lane] = {
+                'limit': _setting(lane, 'LIMIT') or None, 'queue': _setting(lane, 'QUEUE'),
+                'requests': s['requests'], 'shed': s['shed'], 'active': s['active'], 'peak': s['peak'],
+                'waiting': _waiting[lane],
+                'wait_ms_p50': _percentile(s['waits'], 50), 'wait_ms_p95': _percentile(s['waits'], 95),
+                'wait_ms_max': round(max(s['waits']), 1) if s['waits'] else 0.0,
+                'service_ms_p50': _percentile(s['service'], 50), 'service_ms_p95': _percentile(s['service'], 95),
+            }
+        return {'pid': os.getpid(), 'purchases_in_flight': _purchases['active'], 'lanes': out}
+
+def _acquire(lane, slot):
+    """Take a slot at once, or wait in the lane's bounded queue. False means shed."""
+    if slot.acquire(blocking=False):
+        return True
+    with _lock:
+        if _waiting[lane] >= _setting(lane, 'QUEUE'):
+            return False
+        _waiting[lane] += 1
+    try:
+        return slot.acquire(timeout=_setting(lane, 'WAIT_MS') / 1000)
+    finally:
+        with _lock:
+            _waiting[lane] -= 1
+
+def init_app(app):
+    """Admit each request into its lane before any other handler runs, and release it on teardown."""
+    @app.before_request
+    def _admit():
+        lane = classify()
+        slot = _semaphore(lane) if request.endpoint != 'static' else None
+        purchase = request.endpoint in _PURCHASE_ENDPOINTS
+        start = time.perf_counter()
+        if slot is not None:
+            pressure = int(os.environ.get('LANE_PRESSURE', '2'))
+            if lane in SHEDDABLE and pressure and _purchases['active'] >= pressure:
+                return _shed(lane)
+            if not _acquire(lane, slot):
+                return _shed(lane)
+        admitted = time.perf_counter()
+        g.lane = (lane, slot, admitted, (admitted - start) * 1000, purchase)
+        with _lock:
+            _purchases['active'] += purchase
+            s = _stats[lane]
+            s['requests'] += 1
+            s['active'] += 1
+            s['peak'] = max(s['peak'], s['active'])
+            s['waits'].append(g.lane[3])
+
+    @app.after_request
+    def _server_timing(resp):
+        if g.get('lane'):
+            lane, _, _, waited, _ = g.lane
+            resp.headers.add('Server-Timing', f'queue;desc="{lane}";dur={waited:.1f}')
+        return resp
+
+    @app.teardown_request
+    def _release(exc):
+        admitted = g.pop('lane', None)
+        if not admitted:
+            return
+        lane, slot, started, _, purchase = admitted
+        with _lock:
+            _purchases['active'] -= purchase
+            s = _stats[lane]
+            s['active'] -= 1
+            s['service'].append((time.perf_counter() - started) * 1000)
+        if slot is not None:
+            slot.release()
@@ -0,0 +1,91 @@
+"""
+Chunked admin maintenance.
+
+Bulk deletes run as set-based statements over bounded chunks: each chunk picks
+up to MAINTENANCE_CHUNK_SIZE primary keys, deletes them with one
+DELETE ... WHERE key IN (...) AND <condition> (so rows that stopped matching
+in between, e.g. a user who just bought something, are left alone), and
+commits. Locks are therefore held for one short transaction at a time and
+process_barcode can get in between chunks; MAINTENANCE_CHUNK_PAUSE_MS adds a
+breather on top.
+
+Every operation takes dry_run=True to just count what it would delete, and a
+progress(done, total) callback that is called after each chunk.
+
+Bulk statements skip the ORM flush hooks, so the caches that depend on users
+and transactions are invalidated here.
+"""
+import os
+import time
+from sqlalchemy import exists, and_, true
+from models import db, Users, Transactions
+import fragment_cache
+import admin_search
+import avatar_atlas
+import history
+
+def _chunk_size():
+    return max(int(os.environ.get('MAINTENANCE_CHUNK_SIZE', '500')), 1)
+
+def _pause():
+    time.sleep(int(os.environ.get('MAINTENANCE_CHUNK_PAUSE_MS', '50')) / 1000)
+
+def _run(model, key, condition, dry_run, progress):
+    """Delete rows of model matching condition in key-ordered chunks. Returns (count, deleted keys)."""
+    total = db.session.query(model).filter(condition).count()
+    if dry_run or not total:
+        db.session.rollback()  # end the counting transaction
+        return total, []
+    deleted, done = [], 0
+    while True:
+        ids = [row[0] for row in db.session.query(key).filter(condition).order_by(key).limit(_chunk_size()).all()]
+        if not ids:
+            break
+        done += db.session.query(model).filter(key.in_(ids), condition).delete(synchronize_session=False)
+        db.session.commit()
+        deleted.extend(ids)
+        if progress:
+            progress(done, total)
+        if len(ids) < _chunk_size():
+            break
+        _pause()
+    return done, deleted
+
+def _user_has_transactions():
+    return exists().where(Transactions.user_id == Users.user_id)
+
+def purge_idle_users(keep_user_id=None, dry_run=False, progress=None):
+    """Delete users with no transactions (never keep_user_id). Returns the number deleted (or that would be)."""
+    condition = ~_user_has_transactions()
+    if keep_user_id is not None:
+        condition = and_(condition, Users.user_id != keep_user_id)
+    count, deleted = _run(Users, Users.user_id, condition, dry_run, progress)
+    if deleted:
+        for uid in deleted:
+            avatar_atlas.update(uid, None)
+        fragment_cache.bump('users')
+        admin_search.invalidate('users')
+    return count
+
+def delete_transactions(user_id=None, dry_run=False, progress=None):
+    """Delete one user's transactions, or everyone's when user_id is None. Returns the count."""
+    condition = Transactions.user_id == user_id if user_id is not None else true()
+    count, deleted = _run(Transactions, Transactions.transaction_id, condition, dry_run, progress)
+    if deleted:
+        import forecast
+        forecast.invalidate()
+        history.invalidate(user_id)
+    return count
+
+def delete_user(user_id, dry_run=False, progress=None):
+    """Delete a user's transactions in chunks, then the user. Returns the number of transactions removed."""
+    count = delete_transactions(user_id, dry_run=dry_run, progress=progress)
+    if dry_run:
+        return count
+    db.session.query(Users).filter(Users.user_id == user_id, ~_user_has_transactions())\
+        .delete(synchronize_session=False)
+    db.session.commit()
+    avatar_atlas.update(user_id, None)
+    fragment_cache.bump('users')
+    admin_search.invalidate('users')
+    return count
@@ -1,15 +1,127 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
+from sqlalchemy.schema import CreateIndex
+from db_routing import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})  # reads may go to a replica, see db_routing.py
 
-class Users(db.Model):
+def ensure_tables(*models):
+    """Create tables for the given models if they don't exist yet. Returns the tables created.
+
+    Runs from `python jobs.py migrate` at deploy (no migration tool here).
+    """
+    inspector = db.inspect(db.engine)
+    missing = [m for m in models if not inspector.has_table(m.__tablename__)]
+    for model in missing:
+        model.__table__.create(db.engine)
+    return [m.__tablename__ for m in missing]
+
+def ensure_site_columns(*models):
+    """Add the indexed Site_ID column to tables created before multi-site support. Returns the tables changed.
+
+    Runs from `python jobs.py migrate` at deploy, never from a request (see sites.check_schema).
+    """
+    inspector = db.inspect(db.engine)
+    changed = []
+    for model in models:
+        name = model.__tablename__
+        if not inspector.has_table(name):
+            continue
+        if 'Site_ID' not in {c['name'] for c in inspector.get_columns(name)}:
+            if db.engine.dialect.name == 'mssql':
+                ddl = f"ALTER TABLE [{name}] ADD [Site_ID] INT NOT NULL CONSTRAINT [DF_{name}_Site_ID] DEFAULT 1"
+            else:
+                ddl = f'ALTER TABLE "{name}" ADD COLUMN "Site_ID" INTEGER NOT NULL DEFAULT 1'
+            with db.engine.begin() as conn:
+                conn.execute(db.text(ddl))
+            changed.append(name)
+        if f'ix_{name}_Site_ID' not in {i['name'] for i in inspector.get_indexes(name)}:
+            with db.engine.begin() as conn:
+                conn.execute(db.text(f'CREATE INDEX "ix_{name}_Site_ID" ON "{name}" ("Site_ID")'))
+            if name not in changed:
+                changed.append(name)
+    return changed
+
+def missing_site_columns(*models):
+    """Existing tables among models that still lack Site_ID (ensure_site_columns hasn't run)."""
+    inspector = db.inspect(db.engine)
+    return [m.__tablename__ for m in models if inspector.has_table(m.__tablename__)
+            and 'Site_ID' not in {c['name'] for c in inspector.get_columns(m.__tablename__)}]
+
+def ensure_site_keys():
+    """Key the per-site tables by site on a database that predates it. Returns the constraints created.
+
+    Products become unique per (Site_ID, UPC_Code), Wallpapers per (Site_ID, Slot) and
+    Card_ID per site, and an existing Transactions -> Products foreign key is rebuilt on
+    both columns. Runs from `python jobs.py migrate` in one transaction. SQL Server only:
+    SQLite can't change a primary key in place, so a dev database is recreated instead.
+    """
+    if db.engine.dialect.name != 'mssql':
+        return []
+    inspector = db.inspect(db.engine)
+    changed = []
+    with db.engine.begin() as conn:
+        pk = inspector.get_pk_constraint('Products')
+        if pk['constrained_columns'] != ['Site_ID', 'UPC_Code']:
+            fks = [fk for fk in inspector.get_foreign_keys('Transactions') if fk['referred_table'] == 'Products']
+            for fk in fks:
+                conn.execute(db.text(f"ALTER TABLE [Transactions] DROP CONSTRAINT [{fk['name']}]"))
+            conn.execute(db.text(f"ALTER TABLE [Products] DROP CONSTRAINT [{pk['name']}]"))
+            conn.execute(db.text("ALTER TABLE [Products] ADD CONSTRAINT [PK_Products] PRIMARY KEY ([Site_ID], [UPC_Code])"))
+            changed.append('PK_Products')
+            if fks:
+                conn.execute(db.text("ALTER TABLE [Transactions] ADD CONSTRAINT [FK_Transactions_Products] "
+                                     "FOREIGN KEY ([Site_ID], [UPC_Code]) REFERENCES [Products] ([Site_ID], [UPC_Code])"))
+                changed.append('FK_Transactions_Products')
+        pk = inspector.get_pk_constraint('Wallpapers')
+        if pk['constrained_columns'] != ['Site_ID', 'Slot']:
+            conn.execute(db.text(f"ALTER TABLE [Wallpapers] DROP CONSTRAINT [{pk['name']}]"))
+            conn.execute(db.text("ALTER TABLE [Wallpapers] ADD CONSTRAINT [PK_Wallpapers] PRIMARY KEY ([Site_ID], [Slot])"))
+            # sites used to share one slot range, five each (site 2 had 6-10); number them 1-5 again
+            conn.execute(db.text("UPDATE [Wallpapers] SET [Slot] = [Slot] - ([Site_ID] - 1) * 5 WHERE [Site_ID] > 1"))
+            changed.append('PK_Wallpapers')
+        card_keys = conn.execute(db.text(
+            "SELECT kc.name FROM sys.key_constraints kc "
+            "JOIN sys.index_columns ic ON ic.object_id = kc.parent_object_id AND ic.index_id = kc.unique_index_id "
+            "JOIN sys.columns c ON c.object_id = ic.object_id AND c.column_id = ic.column_id "
+            "WHERE kc.parent_object_id = OBJECT_ID('Users') AND kc.type = 'UQ' "
+            "GROUP BY kc.name HAVING COUNT(*) = 1 AND MAX(c.name) = 'Card_ID'")).scalars().all()
+        for name in card_keys:
+            conn.execute(db.text(f"ALTER TABLE [Users] DROP CONSTRAINT [{name}]"))
+        if conn.execute(db.text("SELECT OBJECT_ID('UQ_Users_Site_Card', 'UQ')")).scalar() is None:
+            conn.execute(db.text("ALTER TABLE [Users] ADD CONSTRAINT [UQ_Users_Site_Card] UNIQUE ([Site_ID], [Card_ID])"))
+            changed.append('UQ_Users_Site_Card')
+    return changed
+
+def ensure_index(model, name):
+    """Create one of a model's declared indexes on an existing table. Returns True if it was built.
+
+    Builds scan the whole table, so this runs from `python jobs.py migrate` at
+    deploy, never from a request; SQL Server builds online so purchases
+    keep writing meanwhile.
+    """
+    if any(i['name'] == name for i in db.inspect(db.engine).get_indexes(model.__tablename__)):
+        return False
+    index = next(i for i in model.__table__.indexes if i.name == name)
+    ddl = str(CreateIndex(index).compile(dialect=db.engine.dialect))
+    if db.engine.dialect.name == 'mssql':
+        ddl += ' WITH (ONLINE = ON)'
+    with db.engine.begin() as conn:
+        conn.execute(db.text(ddl))
+    return True
+
+class SiteScoped:
+    """Rows that belong to one site (shop). Reads are filtered and inserts stamped by sites.py."""
+    site_id = db.Column('Site_ID', db.Integer, nullable=False, default=1, index=True)
+
+class Users(SiteScoped, db.Model):
     __tablename__ = 'Users'
+    __table_args__ = (db.UniqueConstraint('Site_ID', 'Card_ID', name='UQ_Users_Site_Card'),)  # cards are per shop
     user_id = db.Column('User_ID', db.Integer, primary_key=True)
     first_name = db.Column('First_Name', db.String(50))
     last_name = db.Column('Last_Name', db.String(50))
     screen_name = db.Column('Screen_Name', db.String(50))
-    card_id = db.Column('Card_ID', db.String(50), unique=True)
+    card_id = db.Column('Card_ID', db.String(50))
     balance = db.Column('Balance', db.Numeric(10, 2), default=0.00)
     last_seen = db.Column('last_seen', db.DateTime, default=datetime.utcnow)
     pin = db.Column('PIN', db.String(64))
@@ -34,9 +146,10 @@ class Users(db.Model):
             'avatar': self.avatar or ""
         }
 
-class Products(db.Model):
+class Products(SiteScoped, db.Model):
     __tablename__ = 'Products'
-    upc_code = db.Column('UPC_Code', db.String(50), primary_key=True)
+    __table_args__ = (db.PrimaryKeyConstraint('Site_ID', 'UPC_Code', name='PK_Products'),)  # each shop has its own catalogue
+    upc_code = db.Column('UPC_Code', db.String(50))
     manufacturer = db.Column('Manufacturer', db.String(100))
     description = db.Column('Description', db.String(100))
     size = db.Column('Size', db.String(50))
@@ -61,16 +174,56 @@ class Products(db.Model):
             'image_url': self.image_url or ""
         }
 
-class Wallpapers(db.Model):
+class Wallpapers(SiteScoped, db.Model):
     __tablename__ = 'Wallpapers'
-    slot = db.Column('Slot', db.Integer, primary_key=True, autoincrement=False)  # 1–5
+    __table_args__ = (db.PrimaryKeyConstraint('Site_ID', 'Slot', name='PK_Wallpapers'),)
+    slot = db.Column('Slot', db.Integer, autoincrement=False)  # 1–5 per site
     image_landscape = db.Column('Image_Landscape', db.Text, nullable=True)
     image_portrait  = db.Column('Image_Portrait',  db.Text, nullable=True)
 
-class Transactions(db.Model):
+class Transactions(SiteScoped, db.Model):
     __tablename__ = 'Transactions'
+    __table_args__ = (
+        db.Index('ix_Transactions_User_Date', 'User_ID', 'Transaction_Date', 'Transaction_ID'),  # personal history, newest first
+        db.ForeignKeyConstraint(['Site_ID', 'UPC_Code'], ['Products.Site_ID', 'Products.UPC_Code'], name='FK_Transactions_Products'),
+    )
     transaction_id = db.Column('Transaction_ID', db.Integer, primary_key=True)
     user_id = db.Column('User_ID', db.Integer, db.ForeignKey('Users.User_ID'))
-    upc_code = db.Column('UPC_Code', db.String(50), db.ForeignKey('Products.UPC_Code'))
+    upc_code = db.Column('UPC_Code', db.String(50))
+    amount = db.Column('Amount', db.Numeric(10, 2))
+    transaction_date = db.Column('Transaction_Date', db.DateTime, default=datetime.utcnow)
+
+class JobLeases(db.Model):
+    __tablename__ = 'Job_Leases'
+    name = db.Column('Name', db.String(50), primary_key=True)
+    holder = db.Column('Holder', db.String(100))
+    expires_at = db.Column('Expires_At', db.DateTime)
+
+class JobRuns(db.Model):
+    __tablename__ = 'Job_Runs'
+    __table_args__ = (db.UniqueConstraint('Job_Name', 'Slot', name='UQ_Job_Runs_Slot'),)
+    run_id = db.Column('Run_ID', db.Integer, primary_key=True)
+    job_name = db.Column('Job_Name', db.String(50), nullable=False)
+    slot = db.Column('Slot', db.String(40), nullable=False)
+    holder = db.Column('Holder', db.String(100))
+    started_at = db.Column('Started_At', db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column('Finished_At', db.DateTime)
+    duration_ms = db.Column('Duration_Ms', db.Integer)
+    status = db.Column('Status', db.String(20), default='running')
+    error = db.Column('Error', db.String(500))
+
+class NotificationPrefs(db.Model):
+    __tablename__ = 'Notification_Prefs'
+    user_id = db.Column('User_ID', db.Integer, primary_key=True, autoincrement=False)  # no FK: must not block user deletes
+    mode = db.Column('Mode', db.String(10), nullable=False, default='instant')  # instant | visit | daily
+
+class NotificationOutbox(db.Model):
+    __tablename__ = 'Notification_Outbox'
+    outbox_id = db.Column('Outbox_ID', db.Integer, primary_key=True)
+    user_id = db.Column('User_ID', db.Integer, index=True)
+    description = db.Column('Description', db.String(100))
     amount = db.Column('Amount', db.Numeric(10, 2))
-    transaction_date = db.Column('Transaction_Date', db.DateTime, default=datetime.utcnow)
\ No newline at end of file
+    balance_after = db.Column('Balance_After', db.Numeric(10, 2))
+    created_at = db.Column('Created_At', db.DateTime, default=datetime.utcnow)
+    batch = db.Column('Batch', db.String(32), index=True)  # set when a flush claims the row
+    sent_at = db.Column('Sent_At', db.DateTime)
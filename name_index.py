@@ -0,0 +1,94 @@
+"""
+Type-ahead name index for the kiosk user picker.
+
+Holds every user's first, last and screen name as lowercase tokens in one
+sorted list, so a prefix lookup is a bisect plus a short scan. Multi-word
+queries must match every word; when nothing matches by prefix, tokens within
+one edit of the typed prefix are accepted so small typos still find people.
+
+The index follows the 'users' version in fragment_cache (bumped whenever a
+displayed user field changes) and is rebuilt lazily on the next lookup.
+"""
+import time
+import bisect
+import threading
+from models import db, Users
+import fragment_cache
+import sites
+
+_indexes = {}  # site id -> {'version', 'built', 'data'}
+_lock = threading.Lock()
+
+def _tokens(*names):
+    return {word for name in names if name for word in name.lower().replace('-', ' ').split()}
+
+def _build():
+    rows = db.session.query(Users.user_id, Users.first_name, Users.last_name, Users.screen_name)\
+        .order_by(db.func.coalesce(Users.screen_name, Users.first_name).asc()).all()
+    tokens = sorted((word, uid) for uid, first, last, screen in rows for word in _tokens(first, last, screen))
+    return {
+        'tokens': tokens,
+        'keys': [t[0] for t in tokens],
+        'order': {row[0]: pos for pos, row in enumerate(rows)},  # picker display order
+    }
+
+def _current():
+    version = fragment_cache.version('users')
+    site_id = sites.current_id()
+    with _lock:
+        index = _indexes.get(site_id)
+        if index and index['version'] == version and time.monotonic() - index['built'] < fragment_cache.ttl():
+            return index['data']
+    data = _build()
+    with _lock:
+        _indexes[site_id] = {'data': data, 'version': version, 'built': time.monotonic()}
+    return data
+
+def _within_one_edit(a, b):
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    i = j = edits = 0
+    while i < len(a) and j < len(b):
+        if a[i] != b[j]:
+            edits += 1
+            if edits > 1:
+                return False
+            if len(a) == len(b):
+                i += 1
+        else:
+            i += 1
+        j += 1
+    return edits + (len(b) - j) + (len(a) - i) <= 1
+
+def _prefix_hits(index, word):
+    hits = set()
+    pos = bisect.bisect_left(index['keys'], word)
+    for token, uid in index['tokens'][pos:]:
+        if not token.startswith(word):
+            break
+        hits.add(uid)
+    return hits
+
+def _fuzzy_hits(index, word):
+    if len(word) < 3:
+        return set()
+    return {uid for token, uid in index['tokens']
+            if _within_one_edit(token[:len(word)], word) or _within_one_edit(token, word)}
+
+def lookup(query, limit=None):
+    """User IDs matching query, in picker display order."""
+    words = sorted(_tokens(query))
+    index = _current()
+    if not words:
+        ids = list(index['order'])
+    else:
+        ids = None
+        for word in words:
+            hits = _prefix_hits(index, word) or _fuzzy_hits(index, word)
+            ids = hits if ids is None else ids & hits
+            if not ids:
+                return []
+        ids = sorted(ids, key=lambda uid: index['order'].get(uid, 0))
+    return ids[:limit] if limit else ids
@@ -2,8 +2,10 @@
 """
 Standalone nightly report script.
 
-Run this on a schedule (cron, Azure WebJob, Azure Timer Function, etc.)
-to email the daily report to all super admins.
+The web app now sends the report itself (see scheduler.py, NIGHTLY_REPORT_TIME).
+This script remains for external cron / Azure WebJob setups; it claims the same
+per-day slot, so it never double-sends with the in-app scheduler. It builds the
+app without web routes - `python jobs.py run nightly_report` is equivalent.
 
 Usage:
     python nightly_report.py
@@ -16,13 +18,15 @@ import os
 # Ensure the app directory is on the path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from app import app
-from routes import send_nightly_report
+from factory import create_app
+import jobs
 
 if __name__ == '__main__':
-    success = send_nightly_report(app)
-    if success:
+    result = jobs.run(create_app(web=False), 'nightly_report')
+    if result == 'ok':
         print("Nightly report sent successfully.")
+    elif result == 'skipped':
+        print("Nightly report already sent today.")
     else:
         print("Failed to send nightly report. Check SMTP config and super admin emails.")
         sys.exit(1)
@@ -0,0 +1,186 @@
+"""
+Nightly report engine.
+
+The report is computed once per NZ report date: section data is gathered in
+three queries, rendered through templates/nightly_report_email.html in one
+pass and serialised to CSV attachments. The finished artefact is cached per
+site and date (REPORT_CACHE_TTL seconds) so re-triggers and the web preview
+reuse it, and each site's email goes to that site's super admins over a
+single SMTP connection.
+"""
+import os
+import io
+import csv
+import time
+import smtplib
+import threading
+from datetime import datetime, timedelta
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from email.mime.application import MIMEApplication
+from flask import render_template
+from models import db, Users, Products, Transactions
+import forecast
+import db_routing
+import sites
+
+LOW_STOCK = 3
+
+_cache = {}
+_lock = threading.Lock()
+
+def _ttl():
+    return int(os.environ.get('REPORT_CACHE_TTL', '300'))
+
+def _display_name(u):
+    real = f"{u.first_name or ''} {u.last_name or ''}".strip()
+    return f"{real} ({u.screen_name})" if u.screen_name else real
+
+def report_window():
+    """(date key, UTC start, UTC end, long date label) for today in NZ."""
+    import pytz
+    nz = pytz.timezone('Pacific/Auckland')
+    now_nz = datetime.now(nz)
+    today_start = nz.localize(datetime(now_nz.year, now_nz.month, now_nz.day))
+    today_end = today_start + timedelta(days=1)
+    # Convert to UTC for DB queries
+    start_utc = today_start.astimezone(pytz.utc).replace(tzinfo=None)
+    end_utc = today_end.astimezone(pytz.utc).replace(tzinfo=None)
+    return now_nz.strftime('%Y-%m-%d'), start_utc, end_utc, now_nz.strftime("%A %d %B %Y")
+
+def build_sections(start_utc, end_utc):
+    """Precompute the three report sections as plain dicts."""
+    import pytz
+    nz = pytz.timezone('Pacific/Auckland')
+
+    txs = db.session.query(Transactions, Users, Products)\
+        .outerjoin(Users, Users.user_id == Transactions.user_id)\
+        .outerjoin(Products, db.and_(Products.site_id == Transactions.site_id, Products.upc_code == Transactions.upc_code))\
+        .filter(Transactions.transaction_date >= start_utc,
+                Transactions.transaction_date < end_utc)\
+        .order_by(Transactions.transaction_date).all()
+    transactions = [{
+        'time': pytz.utc.localize(t.transaction_date).astimezone(nz).strftime("%H:%M") if t.transaction_date else "",
+        'name': _display_name(u) if u else "Unknown",
+        'desc': p.description if p else "Payment",
+        'amount': float(t.amount or 0),
+    } for t, u, p in txs]
+
+    balances = [{'name': _display_name(u), 'balance': float(u.balance or 0)}
+                for u in Users.query.order_by(Users.last_name, Users.first_name).all()]
+
+    outlook = forecast.get_forecast()
+    stock = []
+    for p in Products.query.order_by(Products.stock_level.asc(), Products.description).all():
+        f = outlook.get(p.upc_code, {})
+        stock.append({'name': p.description or p.upc_code, 'category': p.category or '',
+                      'soh': p.stock_level or 0, 'low': (p.stock_level or 0) <= LOW_STOCK,
+                      'velocity': f.get('velocity', 0.0), 'days_left': f.get('days_left'),
+                      'reorder': f.get('reorder', False)})
+
+    return {
+        'transactions': transactions,
+        'daily_total': sum(t['amount'] for t in transactions),
+        'balances': balances,
+        'stock': stock,
+        'reorder': forecast.reorder_list(),
+    }
+
+def _csv(header, rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(header)
+    writer.writerows(rows)
+    return buf.getvalue()
+
+def render_artefact(date_key, label, sections):
+    """Render the HTML body and CSV attachments from precomputed sections."""
+    html = render_template('nightly_report_email.html', report_date=label, **sections)
+    attachments = {
+        f"transactions-{date_key}.csv": _csv(['Time', 'Staff', 'Product', 'Amount'],
+            [(t['time'], t['name'], t['desc'], f"{t['amount']:.2f}") for t in sections['transactions']]),
+        f"balances-{date_key}.csv": _csv(['Name', 'Balance'],
+            [(b['name'], f"{b['balance']:.2f}") for b in sections['balances']]),
+        f"stock-{date_key}.csv": _csv(['Product', 'Category', 'Stock', 'Low', 'Sold/day', 'Days left'],
+            [(s['name'], s['category'], s['soh'], 'LOW' if s['low'] else '', f"{s['velocity']:.2f}",
+              '' if s['days_left'] is None else s['days_left']) for s in sections['stock']]),
+        f"reorder-{date_key}.csv": _csv(['UPC', 'Product', 'Stock', 'Sold/day', 'Days left', 'Suggested qty'],
+            [(r['upc_code'], r['description'], r['stock_level'], f"{r['velocity']:.2f}", r['days_left'], r['suggested_qty'])
+             for r in sections['reorder']]),
+    }
+    return {'date': date_key, 'label': label, 'html': html, 'attachments': attachments}
+
+def get_report(refresh=False):
+    """Today's report artefact, from cache unless stale or refresh=True. Needs an app context."""
+    date_key, start_utc, end_utc, label = report_window()
+    cache_key = (sites.current_id(), date_key)
+    with _lock:
+        hit = _cache.get(cache_key)
+    if hit and not refresh and time.monotonic() - hit[0] < _ttl():
+        return hit[1]
+    with db_routing.use_replica():  # read-only and a few seconds of lag is fine for a daily report
+        sections = build_sections(start_utc, end_utc)
+    artefact = render_artefact(date_key, label, sections)
+    with _lock:
+        for key in [k for k in _cache if k[1] != date_key]:
+            del _cache[key]  # only today's reports are ever reused
+        _cache[cache_key] = (time.monotonic(), artefact)
+    return artefact
+
+def generate_nightly_report_html(app):
+    """Build the nightly report HTML with 3 sections. Must be called within app context."""
+    return get_report()['html']
+
+def send_nightly_report(app):
+    """Email each site's report to that site's super admins (only the current site when called from a request)."""
+    requested = sites.current_id()
+    with app.app_context():
+        site_ids = [requested] if requested is not None else [site['id'] for site in sites.all_sites()]
+        sent, failure = False, None
+        for site_id in site_ids:
+            with sites.use_site(site_id) as site:
+                try:
+                    sent = _send_site_report(site) or sent
+                except Exception as exc:  # one site's SMTP failure mustn't stop the others
+                    failure = failure or exc
+        if failure:
+            raise failure  # recorded as 'error' in Job_Runs
+        return sent
+
+def _send_site_report(site):
+    """Send the current site's report to its super admins over one SMTP session.
+
+    Returns False if there is nobody to send to or SMTP isn't configured; SMTP errors propagate.
+    """
+    admins = Users.query.filter_by(is_super_admin=True).all()
+    recipients = [a.email for a in admins if a.email]
+    if not recipients:
+        return False
+
+    smtp_host = os.environ.get('SMTP_HOST', 'mail.smtp2go.com')
+    smtp_port = int(os.environ.get('SMTP_PORT', 2525))
+    smtp_user = os.environ.get('SMTP_USER', '')
+    smtp_pass = os.environ.get('SMTP_PASS', '')
+    smtp_from = os.environ.get('SMTP_FROM', smtp_user)
+    if not smtp_user or not smtp_pass:
+        return False
+
+    report = get_report()
+    shop = f" ({site['name']})" if site and len(sites.all_sites()) > 1 else ""
+    msg = MIMEMultipart('mixed')
+    msg['Subject'] = f"Snackshack Daily Report{shop} - {datetime.now().strftime('%d %b %Y')}"
+    msg['From'] = smtp_from
+    msg.attach(MIMEText(report['html'], 'html'))
+    for filename, content in report['attachments'].items():
+        part = MIMEApplication(content.encode('utf-8'), _subtype='csv')
+        part.add_header('Content-Disposition', 'attachment', filename=filename)
+        msg.attach(part)
+
+    with smtplib.SMTP(smtp_host, smtp_port) as server:
+        server.starttls()
+        server.login(smtp_user, smtp_pass)
+        for addr in recipients:
+            del msg['To']
+            msg['To'] = addr
+            server.sendmail(smtp_from, addr, msg.as_string())
+    return True
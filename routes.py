@@ -3,19 +3,29 @@ import re
 import base64
 import random
 import hashlib
-import smtplib
 import threading
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-import requests
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify, current_app, make_response
 from werkzeug.utils import secure_filename
 from models import db, Users, Products, Transactions, Wallpapers
-from datetime import datetime, timedelta
+import fragment_cache
+import avatar_atlas
+import admin_search
+import name_index
+import scheduler
+import digests
+import db_routing
+import maintenance
+import uploads
+import history
+import cart
+import lanes
+from datetime import datetime
 from decimal import Decimal
 from sqlalchemy.exc import IntegrityError
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+AVATAR_MAX = PRODUCT_IMAGE_MAX = 2 * 1024 * 1024
+WALLPAPER_MAX = 5 * 1024 * 1024
 
 def hash_pin(pin):
     """Hash a 4-digit PIN with the app secret key as salt."""
@@ -63,6 +73,7 @@ def check_sms_cap():
 def send_sms_code(app, phone_number, user_name, code):
     """Send verification code via MessageMedia SMS."""
     def _send():
+        import requests
         with app.app_context():
             api_key = os.environ.get('MESSAGEMEDIA_API_KEY', '')
             api_secret = os.environ.get('MESSAGEMEDIA_API_SECRET', '')
@@ -91,6 +102,9 @@ def send_sms_code(app, phone_number, user_name, code):
 
 def _send_sms_admin_notification(app, admin_email, user_name, phone, count, cap):
     """Email admin whenever an SMS is sent, showing daily usage."""
+    import smtplib
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
     smtp_host = os.environ.get('SMTP_HOST', 'mail.smtp2go.com')
     smtp_port = int(os.environ.get('SMTP_PORT', 2525))
     smtp_user = os.environ.get('SMTP_USER', '')
@@ -121,6 +135,9 @@ def _send_sms_admin_notification(app, admin_email, user_name, phone, count, cap)
 def send_purchase_email(app, user_email, user_name, product_desc, price, new_balance):
     """Send purchase notification email via SMTP2Go in a background thread."""
     def _send():
+        import smtplib
+        from email.mime.text import MIMEText
+        from email.mime.multipart import MIMEMultipart
         with app.app_context():
             smtp_host = os.environ.get('SMTP_HOST', 'mail.smtp2go.com')
             smtp_port = int(os.environ.get('SMTP_PORT', 2525))
@@ -160,10 +177,12 @@ def process_barcode(barcode):
     user = Users.query.filter_by(card_id=barcode).first()
     if user:
         if user.pin: return {"status": "needs_pin", "user_id": user.user_id}
-        session['user_id'] = int(user.user_id)
+        sign_in(user)
         user.last_seen = datetime.utcnow()
         db.session.commit()
         return {"status": "logged_in"}
+    if 'user_id' in session and cart.enabled():
+        return cart.add(barcode)
     if 'user_id' in session:
         product = Products.query.filter_by(upc_code=barcode).first()
         if product:
@@ -175,13 +194,32 @@ def process_barcode(barcode):
             u.balance = Decimal(str(u.balance or 0.0)) - price
             product.stock_level = (product.stock_level or 0) - 1
             db.session.add(Transactions(user_id=u.user_id, upc_code=product.upc_code, amount=price))
+            notify = bool(u.email and u.notify_on_purchase)
+            mode = digests.mode_for(u.user_id) if notify else None
+            if mode in ('visit', 'daily'):
+                digests.buffer_purchase(u, product.description, price, u.balance)
             db.session.commit()
-            if u.email and u.notify_on_purchase:
+            if mode == 'instant':
                 display_name = u.screen_name or u.first_name
                 send_purchase_email(current_app._get_current_object(), u.email, display_name, product.description, float(price), float(u.balance))
             return {"status": "purchased", "description": product.description, "price": float(price)}
     return {"status": "not_found"}
 
+def sign_in(user):
+    """Make user the session user, first checking out a basket left by whoever was signed in."""
+    if session.get('user_id') != user.user_id:
+        settle_cart()
+    session['user_id'] = int(user.user_id)
+
+def settle_cart():
+    """Check out the signed-in user's basket, if any, and send the instant-mode email."""
+    res = cart.checkout()
+    if res['status'] == 'purchased' and res['mode'] == 'instant':
+        u = res['user']
+        items = ", ".join(f"{desc} x{qty}" if qty > 1 else desc for desc, qty, price in res['lines'])
+        send_purchase_email(current_app._get_current_object(), u.email, u.screen_name or u.first_name, items, res['total'], float(u.balance))
+    return res
+
 @main.route('/')
 def index():
     mobile = is_mobile_site()
@@ -191,18 +229,14 @@ def index():
     if 'user_id' in session:
         current_user = Users.query.get(int(session['user_id']))
 
-    # Alphabetical sorting for 80+ names - prefer screen_name, fallback to first_name
-    all_users = Users.query.order_by(
-        db.func.coalesce(Users.screen_name, Users.first_name).asc()
-    ).all()
-
-    cat_order = ["Drinks", "Snacks", "Candy", "Frozen", "Coffee Pods", "Sweepstake Tickets"]
-    grouped = {cat: [] for cat in cat_order}
-    for p in Products.query.filter_by(is_quick_item=True).all():
-        cat = p.category or "Snacks"
-        if cat not in grouped:
-            grouped[cat] = []
-        grouped[cat].append(p)
+    # User picker and product grid come from the fragment cache; only session bits render per request
+    user_grid = product_categories = product_grid_html = atlas_version = None
+    if current_user:
+        product_categories, product_grid_html = fragment_cache.product_grid()
+    else:
+        user_grid = fragment_cache.user_grid_html(mobile)
+        atlas_css, atlas_version = avatar_atlas.get()
+        atlas_version = atlas_version if atlas_css else None
 
     _wallpapers = Wallpapers.query.order_by(Wallpapers.slot).all()
     wallpaper_slots = [
@@ -212,17 +246,23 @@ def index():
 
     return render_template('index.html',
         user=current_user,
-        users=all_users,
-        grouped_products={k: v for k, v in grouped.items() if v},
+        user_grid_html=user_grid,
+        product_categories=product_categories,
+        product_grid_html=product_grid_html,
+        avatar_atlas_version=atlas_version,
         needs_pin=needs_pin,
         pin_user=pin_user,
         just_bought=request.args.get('bought'),
         just_price=request.args.get('price'),
+        just_added=request.args.get('added'),
         verify_email=request.args.get('verify_email'),
         pending_email=session.get('pending_email'),
         avatar_options=AVATAR_OPTIONS,
         is_mobile=mobile,
+        cart=cart.summary() if current_user and cart.enabled() else None,
         show_register=request.args.get('show_register'),
+        notify_mode=digests.mode_for(current_user.user_id) if current_user else None,
+        notify_modes=digests.MODE_LABELS,
         wallpaper_slots=wallpaper_slots)
 
 
@@ -238,87 +278,178 @@ def terms():
 @main.route('/manual/<barcode>')
 def manual_add(barcode=None):
     res = process_barcode(barcode)
+    if res.get("status") == "added":
+        return redirect(url_for('main.index', added=res.get("description")))
     return redirect(url_for('main.index', bought=res.get("description"), price=res.get("price"))) if res.get("status") == "purchased" else redirect(url_for('main.index'))
 
 @main.route('/scan', methods=['POST'])
 def scan():
     res = process_barcode(request.form.get('barcode', '').strip())
+    if res.get('status') == 'added':
+        return redirect(url_for('main.index', added=res.get('description')))
     return redirect(url_for('main.index', bought=res.get('description'))) if res.get('status') == 'purchased' else redirect(url_for('main.index'))
 
+@main.route('/cart/add/<barcode>', methods=['POST'])
+def cart_add(barcode):
+    if 'user_id' not in session or not cart.enabled(): return jsonify({"error": "cart mode is off"}), 400
+    res = cart.add(barcode.strip())
+    return jsonify(dict(res, cart=cart.summary()))
+
+@main.route('/cart/remove/<barcode>', methods=['POST'])
+def cart_remove(barcode):
+    if 'user_id' not in session: return jsonify({"error": "login required"}), 401
+    cart.remove(barcode)
+    return jsonify({"status": "removed", "cart": cart.summary()})
+
+@main.route('/cart/checkout', methods=['POST'])
+def cart_checkout():
+    if 'user_id' not in session: return redirect(url_for('main.index'))
+    res = settle_cart()
+    if res['status'] != 'purchased':
+        return redirect(url_for('main.index'))
+    bought = f"{res['count']} item{'s' if res['count'] != 1 else ''}"
+    if res['skipped']:
+        bought += f" (sold out: {', '.join(res['skipped'])})"
+    return redirect(url_for('main.index', bought=bought, price=f"{res['total']:.2f}"))
+
 @main.route('/undo')
 def undo():
     uid = session.get('user_id')
     if uid:
         lt = Transactions.query.filter_by(user_id=uid).order_by(Transactions.transaction_date.desc()).first()
         if lt:
-            u, p = Users.query.get(uid), Products.query.get(lt.upc_code)
+            u, p = Users.query.get(uid), Products.query.filter_by(upc_code=lt.upc_code).first()
             u.balance += lt.amount
             if p and lt.amount > 0: p.stock_level += 1
+            history.unbuffer(lt, p.description if p else None)  # same commit, so no digest lists it
             db.session.delete(lt); db.session.commit()
     return redirect(url_for('main.index'))
 
+@main.route('/history')
+def purchase_history():
+    uid = session.get('user_id')
+    if not uid: return redirect(url_for('main.index'))
+    items, next_cursor = history.page(uid)
+    return render_template('history.html', user=Users.query.get(uid), items=items, next_cursor=next_cursor,
+                           months=history.month_totals(uid), undo_minutes=int(history.undo_window().total_seconds() // 60))
+
+@main.route('/api/history')
+def history_json():
+    uid = session.get('user_id')
+    if not uid: return jsonify({"error": "login required"}), 401
+    after = request.args.get('after')
+    items, next_cursor = history.page(uid, limit=request.args.get('limit', 25, type=int), after=after)
+    payload = {"items": items, "next": next_cursor}
+    if not after:
+        payload["months"] = history.month_totals(uid)
+    return jsonify(payload)
+
+@main.route('/history/undo', methods=['POST'])
+def undo_history():
+    uid = session.get('user_id')
+    if not uid: return redirect(url_for('main.index'))
+    count, refunded = history.undo(uid, [i for i in request.form.getlist('transaction_id') if i.isdigit()])
+    if count:
+        flash(f"Undid {count} purchase(s), ${refunded:.2f} refunded.", "success")
+    else:
+        flash(f"Nothing to undo - purchases can only be undone within {int(history.undo_window().total_seconds() // 60)} minutes.", "warning")
+    return redirect(url_for('main.purchase_history'))
+
 @main.route('/admin/products')
 def manage_products():
     if 'user_id' not in session: return redirect(url_for('main.index'))
-    default_cats = ["Drinks", "Snacks", "Candy", "Frozen", "Coffee Pods", "Sweepstake Tickets"]
+    default_cats = fragment_cache.CATEGORY_ORDER
     db_cats = [r[0] for r in db.session.query(Products.category).distinct() if r[0]]
     categories = list(dict.fromkeys(default_cats + db_cats))  # preserve order, deduplicate
-    return render_template('manage_products.html', products=Products.query.order_by(Products.description).all(), categories=categories)
+    import forecast
+    return render_template('manage_products.html', categories=categories, reorder=forecast.reorder_list())
+
+def _listing_json(kind, decorator=None):
+    """Shared handler for the paginated admin listing endpoints.
+
+    decorator is called only once the caller is known to be an admin, and returns
+    a function that adds fields to each item (so expensive lookups never run for 403s).
+    """
+    current = Users.query.get(int(session['user_id'])) if 'user_id' in session else None
+    if not current or not (current.is_admin or current.is_super_admin):
+        return jsonify({"error": "admin access required"}), 403
+    items, next_cursor = admin_search.search(
+        kind,
+        q=request.args.get('q', ''),
+        sort=request.args.get('sort'),
+        descending=request.args.get('dir') == 'desc',
+        limit=request.args.get('limit', 50, type=int),
+        after=request.args.get('after'))
+    if decorator:
+        decorate = decorator()
+        items = [decorate(dict(item)) for item in items]  # index rows are shared - copy before adding fields
+    return jsonify({"items": items, "next": next_cursor})
+
+@main.route('/admin/api/products')
+@db_routing.read_replica
+def list_products():
+    def forecast_fields():
+        import forecast
+        outlook = forecast.get_forecast()
+        def add_forecast(item):
+            f = outlook.get(item['upc_code'], {})
+            item.update(velocity=f.get('velocity', 0.0), days_left=f.get('days_left'), reorder=f.get('reorder', False))
+            return item
+        return add_forecast
+    return _listing_json('products', forecast_fields)
+
+@main.route('/admin/api/users')
+@db_routing.read_replica
+def list_users():
+    return _listing_json('users')
 
 @main.route('/admin/product/save', methods=['POST'])
 def save_product_manual():
+    try:
+        uploads.reject_oversize(PRODUCT_IMAGE_MAX, encoded=True)
+    except uploads.UploadError as e:
+        flash(str(e), "danger")
+        return redirect(url_for('main.manage_products'))
     upc = request.form.get('upc_code', '').strip()
-    p = Products.query.get(upc) or Products(upc_code=upc)
-    if not Products.query.get(upc): db.session.add(p)
+    p = Products.query.filter_by(upc_code=upc).first()
+    if not p:
+        p = Products(upc_code=upc)
+        db.session.add(p)
     p.manufacturer, p.description, p.size = request.form.get('manufacturer'), request.form.get('description'), request.form.get('size')
     p.price, p.category, p.stock_level = Decimal(request.form.get('price', '0.00')), request.form.get('category'), int(request.form.get('stock_level', 0))
     p.is_quick_item = 'is_quick_item' in request.form
 
-    # Store image as base64 in DB so it persists across Azure redeploys
+    # Store image as base64 in DB so it persists across Azure redeploys - streamed in chunks, see uploads.py
     file = request.files.get('product_image')
-    img_saved = False
-    if file:
-        # Determine type from filename or MIME type (clipboard pastes may lack a filename)
+    b64_data = request.form.get('image_base64', '').strip()
+    try:
         mime = None
-        if file.filename and '.' in file.filename:
-            ext = file.filename.rsplit('.', 1)[1].lower()
-            if ext in ALLOWED_EXTENSIONS:
-                mime = 'jpeg' if ext == 'jpg' else ext
-        if not mime and file.content_type:
-            mime_map = {'image/png': 'png', 'image/jpeg': 'jpeg', 'image/webp': 'webp', 'image/gif': 'gif'}
-            mime = mime_map.get(file.content_type.lower())
+        if file:
+            db.session.flush()  # the image is written by primary key, so a new product needs its row first
+            mime = uploads.store_file(file, PRODUCT_IMAGE_MAX, p, 'image_data')
+        elif b64_data:
+            mime = uploads.check_data_uri(b64_data, PRODUCT_IMAGE_MAX)
+            p.image_data = b64_data
         if mime:
-            raw = file.read()
-            if len(raw) <= 2 * 1024 * 1024:
-                p.image_data = f"data:image/{mime};base64,{base64.b64encode(raw).decode()}"
-                p.image_url = secure_filename(f"{upc}.{'jpg' if mime == 'jpeg' else mime}")
-                img_saved = True
-    if not img_saved:
-        b64_data = request.form.get('image_base64', '').strip()
-        if b64_data:
-            match = re.match(r'^data:image/(png|jpe?g|gif|webp);base64,(.+)$', b64_data, re.DOTALL)
-            if match:
-                raw = base64.b64decode(match.group(2))
-                if len(raw) <= 2 * 1024 * 1024:
-                    p.image_data = b64_data
-                    ext = match.group(1).replace('jpeg', 'jpg')
-                    p.image_url = secure_filename(f"{upc}.{ext}")
-
-    db.session.commit()
+            p.image_url = secure_filename(f"{upc}.{'jpg' if mime == 'jpeg' else mime}")
+        db.session.commit()
+    except uploads.UploadError as e:
+        db.session.rollback(); flash(f"Product not saved: {e}", "danger")
     return redirect(url_for('main.manage_products'))
 
 @main.route('/admin/product/delete/<upc>')
 def delete_product(upc):
-    p = Products.query.get(upc)
+    p = Products.query.filter_by(upc_code=upc).first()
     if p:
         try: db.session.delete(p); db.session.commit()
         except IntegrityError: db.session.rollback(); flash("History exists; delete failed.", "danger")
     return redirect(url_for('main.manage_products'))
 
 @main.route('/product_image/<upc>')
+@db_routing.read_replica
 def product_image(upc):
     """Serve product image from DB. Falls back to placeholder."""
-    p = Products.query.get(upc)
+    p = Products.query.filter_by(upc_code=upc).first()
     if p and p.image_data:
         match = re.match(r'^data:image/([\w+]+);base64,(.+)$', p.image_data, re.DOTALL)
         if match:
@@ -330,9 +461,10 @@ def product_image(upc):
     return redirect(url_for('static', filename='images/placeholder.png'))
 
 @main.route('/wallpaper/<int:slot>/<orientation>')
+@db_routing.read_replica
 def wallpaper_image(slot, orientation):
     """Serve wallpaper image (landscape or portrait) from DB."""
-    w = Wallpapers.query.get(slot)
+    w = Wallpapers.query.filter_by(slot=slot).first()
     if w:
         data = w.image_landscape if orientation == 'landscape' else w.image_portrait
         if data:
@@ -362,43 +494,33 @@ def save_wallpaper():
     current = Users.query.get(int(session['user_id']))
     if not current or not (current.is_admin or current.is_super_admin):
         return redirect(url_for('main.index'))
+    try:
+        uploads.reject_oversize(WALLPAPER_MAX)
+    except uploads.UploadError as e:
+        flash(str(e), "danger")
+        return redirect(url_for('main.manage_wallpapers'))
     slot = int(request.form.get('slot', 0))
     orientation = request.form.get('orientation', '')
     if slot < 1 or slot > 5 or orientation not in ('landscape', 'portrait'):
         flash("Invalid slot or orientation.", "danger")
         return redirect(url_for('main.manage_wallpapers'))
-    w = Wallpapers.query.get(slot)
-    if not w:
-        w = Wallpapers(slot=slot)
-        db.session.add(w)
     file = request.files.get('wallpaper_image')
     if file:
-        mime = None
-        if file.filename and '.' in file.filename:
-            ext = file.filename.rsplit('.', 1)[1].lower()
-            if ext in ALLOWED_EXTENSIONS:
-                mime = 'jpeg' if ext == 'jpg' else ext
-        if not mime and file.content_type:
-            mime_map = {'image/png': 'png', 'image/jpeg': 'jpeg', 'image/webp': 'webp', 'image/gif': 'gif'}
-            mime = mime_map.get(file.content_type.lower())
-        if mime:
-            raw = file.read()
-            if len(raw) <= 5 * 1024 * 1024:
-                encoded = f"data:image/{mime};base64,{base64.b64encode(raw).decode()}"
-                if orientation == 'landscape':
-                    w.image_landscape = encoded
-                else:
-                    w.image_portrait = encoded
-                try:
-                    db.session.commit()
-                    flash(f"Wallpaper {slot} ({orientation}) saved.", "success")
-                except Exception as e:
-                    db.session.rollback()
-                    flash(f"Database error saving wallpaper: {e}", "danger")
-            else:
-                flash("Image too large (max 5 MB).", "danger")
-        else:
-            flash("Unsupported image format.", "danger")
+        w = Wallpapers.query.filter_by(slot=slot).first()
+        if not w:
+            w = Wallpapers(slot=slot)
+            db.session.add(w)
+        try:
+            db.session.flush()  # the image is written by primary key, so a new slot needs its row first
+            uploads.store_file(file, WALLPAPER_MAX, w, 'image_landscape' if orientation == 'landscape' else 'image_portrait')
+            db.session.commit()
+            flash(f"Wallpaper {slot} ({orientation}) saved.", "success")
+        except uploads.UploadError as e:
+            db.session.rollback()
+            flash(str(e), "danger")
+        except Exception as e:
+            db.session.rollback()
+            flash(f"Database error saving wallpaper: {e}", "danger")
     return redirect(url_for('main.manage_wallpapers'))
 
 @main.route('/admin/wallpaper/delete/<int:slot>/<orientation>', methods=['POST'])
@@ -408,7 +530,7 @@ def delete_wallpaper(slot, orientation):
     current = Users.query.get(int(session['user_id']))
     if not current or not (current.is_admin or current.is_super_admin):
         return redirect(url_for('main.index'))
-    w = Wallpapers.query.get(slot)
+    w = Wallpapers.query.filter_by(slot=slot).first()
     if w:
         if orientation == 'landscape':
             w.image_landscape = None
@@ -424,7 +546,7 @@ def delete_wallpaper(slot, orientation):
 def pin_verify():
     uid, pin = request.form.get('user_id'), request.form.get('pin', '').strip()
     u = Users.query.get(int(uid))
-    if u and u.pin == hash_pin(pin): session['user_id'] = u.user_id; return redirect(url_for('main.index'))
+    if u and u.pin == hash_pin(pin): sign_in(u); return redirect(url_for('main.index'))
     flash("Incorrect PIN.", "danger"); return redirect(url_for('main.index', needs_pin=uid))
 
 @main.route('/pin_set', methods=['POST'])
@@ -475,6 +597,7 @@ def email_settings():
     # If user is just toggling notification (no email/phone change), save directly
     if new_email == u.email and (new_phone or None) == (u.phone_number or None):
         u.notify_on_purchase = notify
+        digests.set_mode(u.user_id, request.form.get('notify_mode', ''))
         db.session.commit()
         flash("Notification preference saved.", "success")
         return redirect(url_for('main.index'))
@@ -496,6 +619,7 @@ def email_settings():
             u.email = new_email
             u.phone_number = session.get('pending_phone')
             u.notify_on_purchase = notify
+            digests.set_mode(u.user_id, request.form.get('notify_mode', ''))
             session.pop('pending_email', None)
             session.pop('pending_phone', None)
             session.pop('sms_code', None)
@@ -549,6 +673,7 @@ def set_avatar():
         u.avatar = avatar
         u.avatar_data = None  # clear custom photo when picking a preset
         db.session.commit()
+        avatar_atlas.update(u.user_id, None)
     return redirect(url_for('main.index'))
 
 @main.route('/upload_avatar', methods=['POST'])
@@ -558,38 +683,32 @@ def upload_avatar():
     u = Users.query.get(int(session['user_id']))
     if not u:
         return redirect(url_for('main.index'))
+    try:
+        uploads.reject_oversize(AVATAR_MAX)
+    except uploads.UploadError as e:
+        flash(str(e), "warning")
+        return redirect(url_for('main.index'))
     file = request.files.get('avatar_photo')
     if not file or not file.filename:
         flash("No file received.", "warning")
         return redirect(url_for('main.index'))
-    # Determine type from filename or fall back to MIME type (for clipboard pastes)
-    mime = None
-    if file.filename and '.' in file.filename:
-        ext = file.filename.rsplit('.', 1)[1].lower()
-        if ext in ALLOWED_EXTENSIONS:
-            mime = 'jpeg' if ext == 'jpg' else ext
-    if not mime and file.content_type:
-        ct = file.content_type.lower()
-        mime_map = {'image/png': 'png', 'image/jpeg': 'jpeg', 'image/webp': 'webp', 'image/gif': 'gif'}
-        mime = mime_map.get(ct)
-    if not mime:
-        flash("Unsupported image format.", "warning")
-        return redirect(url_for('main.index'))
-    raw = file.read()
-    if len(raw) > 2 * 1024 * 1024:
-        flash("Image too large (max 2 MB).", "warning")
-        return redirect(url_for('main.index'))
     try:
-        u.avatar_data = f"data:image/{mime};base64,{base64.b64encode(raw).decode()}"
+        uploads.store_file(file, AVATAR_MAX, u, 'avatar_data')
         u.avatar = None  # clear preset when uploading custom
         db.session.commit()
+        fragment_cache.bump('users')  # avatar_data was written outside the ORM, so the flush hook can't see it
+        avatar_atlas.update(u.user_id, u.avatar_data)
         flash("Photo updated!", "success")
+    except uploads.UploadError as e:
+        db.session.rollback()
+        flash(str(e), "warning")
     except Exception as e:
         db.session.rollback()
         flash(f"Failed to save photo: {e}", "danger")
     return redirect(url_for('main.index'))
 
 @main.route('/user_avatar/<int:user_id>')
+@db_routing.read_replica
 def user_avatar(user_id):
     """Serve custom avatar photo from DB."""
     u = Users.query.get(user_id)
@@ -603,8 +722,27 @@ def user_avatar(user_id):
             return resp
     return redirect(url_for('static', filename='images/placeholder.png'))
 
+@main.route('/avatars.css')
+@db_routing.read_replica
+def avatar_atlas_css():
+    """Serve every custom avatar photo as one stylesheet for the user picker."""
+    css, version = avatar_atlas.get()
+    resp = make_response(css)
+    resp.headers['Content-Type'] = 'text/css; charset=utf-8'
+    if request.args.get('v') == version:
+        resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        resp.headers['Cache-Control'] = 'no-cache'
+    resp.set_etag(version)
+    return resp.make_conditional(request)
+
 @main.route('/logout')
-def logout(): session.pop('user_id', None); return redirect(url_for('main.index'))
+def logout():
+    settle_cart()
+    uid = session.pop('user_id', None)
+    if uid:
+        digests.flush_user(current_app._get_current_object(), uid)  # per-visit digest, if any
+    return redirect(url_for('main.index'))
 
 @main.route('/register', methods=['POST'])
 def register():
@@ -623,7 +761,7 @@ def register():
         # Store pending verification in session, don't save email until verified
         db.session.add(user)
         db.session.commit()
-        session['user_id'] = user.user_id
+        sign_in(user)
         # Check daily SMS cap before sending
         allowed, count, cap = check_sms_cap()
         if allowed:
@@ -640,10 +778,15 @@ def register():
     else:
         db.session.add(user)
         db.session.commit()
-        session['user_id'] = user.user_id
+        sign_in(user)
         flash("Welcome to the Snack Shoppe!", "success")
         return redirect(url_for('main.index'))
 
+@main.route('/users/filter')
+def filter_users():
+    """Type-ahead for the user picker: matching user IDs in display order."""
+    return jsonify({"ids": name_index.lookup(request.args.get('q', ''), limit=request.args.get('limit', type=int))})
+
 @main.route('/select_user/<int:user_id>')
 def select_user(user_id):
     u = Users.query.get(user_id)
@@ -651,7 +794,7 @@ def select_user(user_id):
     if u:
         if is_mobile_site():
             session.permanent = True
-        session['user_id'] = u.user_id
+        sign_in(u)
         u.last_seen = datetime.utcnow()
         db.session.commit()
     return redirect(url_for('main.index'))
@@ -662,7 +805,7 @@ def select_user(user_id):
 def manage_users():
     if 'user_id' not in session: return redirect(url_for('main.index'))
     current = Users.query.get(int(session['user_id']))
-    return render_template('manage_users.html', users=Users.query.order_by(Users.last_name).all(), current_user=current)
+    return render_template('manage_users.html', current_user=current)
 
 @main.route('/admin/user/save', methods=['POST'])
 def save_user():
@@ -683,13 +826,17 @@ def save_user():
     db.session.commit()
     return redirect(url_for('main.manage_users'))
 
+def _maintenance_log(label):
+    """Progress callback for maintenance.py that writes to the app log."""
+    logger = current_app.logger
+    return lambda done, total: logger.info("%s: %d/%d rows deleted", label, done, total)
+
 @main.route('/admin/user/delete/<int:user_id>')
 def delete_user(user_id):
     user = Users.query.get(user_id)
     if user and int(session.get('user_id')) != user_id:
         try:
-            Transactions.query.filter_by(user_id=user_id).delete()
-            db.session.delete(user); db.session.commit()
+            maintenance.delete_user(user_id, progress=_maintenance_log(f"delete user {user_id}"))
         except Exception:
             db.session.rollback(); flash("Could not delete user.", "danger")
     return redirect(url_for('main.manage_users'))
@@ -698,16 +845,13 @@ def delete_user(user_id):
 def purge_users():
     if 'user_id' not in session:
         return redirect(url_for('main.index'))
-    users_with_tx = db.session.query(Transactions.user_id).distinct()
-    idle_users = Users.query.filter(
-        ~Users.user_id.in_(users_with_tx),
-        Users.user_id != int(session['user_id'])
-    ).all()
-    count = len(idle_users)
-    for u in idle_users:
-        db.session.delete(u)
-    db.session.commit()
-    flash(f"Purged {count} user(s) with no purchase history.", "info")
+    dry_run = request.form.get('dry_run') == '1'
+    count = maintenance.purge_idle_users(keep_user_id=int(session['user_id']), dry_run=dry_run,
+                                         progress=_maintenance_log("purge idle users"))
+    if dry_run:
+        flash(f"{count} user(s) have no purchase history and would be purged.", "info")
+    else:
+        flash(f"Purged {count} user(s) with no purchase history.", "info")
     return redirect(url_for('main.manage_users'))
 
 @main.route('/admin/user/payment', methods=['POST'])
@@ -724,11 +868,12 @@ def record_payment():
 # --- REPORTING ---
 
 @main.route('/admin/monthly_report')
+@db_routing.read_replica
 def monthly_report():
     ym = request.args.get('month', datetime.utcnow().strftime("%Y-%m"))
     start_dt = datetime.strptime(ym, "%Y-%m")
     end_dt = datetime(start_dt.year + (1 if start_dt.month == 12 else 0), (start_dt.month % 12) + 1, 1)
-    tx_rows = db.session.query(Transactions, Products).outerjoin(Products, Products.upc_code == Transactions.upc_code).filter(Transactions.transaction_date >= start_dt, Transactions.transaction_date < end_dt).all()
+    tx_rows = db.session.query(Transactions, Products).outerjoin(Products, db.and_(Products.site_id == Transactions.site_id, Products.upc_code == Transactions.upc_code)).filter(Transactions.transaction_date >= start_dt, Transactions.transaction_date < end_dt).all()
     rows = []
     for u in Users.query.order_by(Users.last_name).all():
         user_txs = [(t, p) for t, p in tx_rows if t.user_id == u.user_id]
@@ -743,19 +888,23 @@ def monthly_report():
 
 @main.route('/admin/nuke-transactions')
 def nuke_transactions():
-    Transactions.query.delete(); db.session.commit(); flash("HISTORY NUKED.", "danger")
+    if request.args.get('dry_run') == '1':
+        flash(f"{maintenance.delete_transactions(dry_run=True)} transaction(s) would be deleted.", "info")
+    else:
+        maintenance.delete_transactions(progress=_maintenance_log("nuke transactions")); flash("HISTORY NUKED.", "danger")
     return redirect(url_for('main.index'))
 
 @main.route('/admin/reset-balances')
 def reset_balances():
-    Users.query.update({Users.balance: 0.00}); db.session.commit(); flash("Balances reset.", "warning")
+    Users.query.update({Users.balance: 0.00}); db.session.commit(); admin_search.invalidate('users'); flash("Balances reset.", "warning")
     return redirect(url_for('main.index'))
 
 @main.route('/admin/get-product/<barcode>')
 def get_product(barcode):
-    p = Products.query.get(barcode.strip())
+    p = Products.query.filter_by(upc_code=barcode.strip()).first()
     if p: return jsonify({"found": True, "mfg": p.manufacturer, "desc": p.description, "size": p.size, "price": str(p.price), "cat": p.category, "soh": p.stock_level})
     try:
+        import requests
         res = requests.get(f"https://world.openfoodfacts.org/api/v0/product/{barcode}.json", timeout=5)
         if res.status_code == 200:
             d = res.json()
@@ -765,165 +914,7 @@ def get_product(barcode):
     except: pass
     return jsonify({"found": False})
 
-# --- Nightly Report ---
-
-def generate_nightly_report_html(app):
-    """Build the nightly report HTML with 3 sections. Must be called within app context."""
-    from datetime import timezone
-    import pytz
-    nz = pytz.timezone('Pacific/Auckland')
-    now_nz = datetime.now(nz)
-    today_start = nz.localize(datetime(now_nz.year, now_nz.month, now_nz.day))
-    today_end = today_start + timedelta(days=1)
-    # Convert to UTC for DB queries
-    today_start_utc = today_start.astimezone(pytz.utc).replace(tzinfo=None)
-    today_end_utc = today_end.astimezone(pytz.utc).replace(tzinfo=None)
-    report_date = now_nz.strftime("%A %d %B %Y")
-
-    # --- Section 1: Daily Transactions ---
-    txs = db.session.query(Transactions, Users, Products)\
-        .outerjoin(Users, Users.user_id == Transactions.user_id)\
-        .outerjoin(Products, Products.upc_code == Transactions.upc_code)\
-        .filter(Transactions.transaction_date >= today_start_utc,
-                Transactions.transaction_date < today_end_utc)\
-        .order_by(Transactions.transaction_date).all()
-
-    tx_rows = ""
-    daily_total = 0.0
-    for t, u, p in txs:
-        real = f"{u.first_name or ''} {u.last_name or ''}".strip() if u else "Unknown"
-        name = f"{real} ({u.screen_name})" if u and u.screen_name else real
-        desc = p.description if p else "Payment"
-        amt = float(t.amount or 0)
-        daily_total += amt
-        tx_time = pytz.utc.localize(t.transaction_date).astimezone(nz).strftime("%H:%M") if t.transaction_date else ""
-        tx_rows += f"<tr><td>{tx_time}</td><td>{name}</td><td>{desc}</td><td style='text-align:right'>${amt:.2f}</td></tr>\n"
-
-    if not tx_rows:
-        tx_rows = "<tr><td colspan='4' style='text-align:center;color:#999;'>No transactions today</td></tr>"
-
-    # --- Section 2: Running Balances ---
-    users = Users.query.order_by(Users.last_name, Users.first_name).all()
-    bal_rows = ""
-    for u in users:
-        bal = float(u.balance or 0)
-        colour = "#dc3545" if bal < 0 else "#333"
-        real = f"{u.first_name or ''} {u.last_name or ''}".strip()
-        display = f"{real} ({u.screen_name})" if u.screen_name else real
-        bal_rows += f"<tr><td>{display}</td><td style='text-align:right;color:{colour};font-weight:bold'>${bal:.2f}</td></tr>\n"
-
-    # --- Section 3: Stock Report (low stock first) ---
-    products = Products.query.order_by(Products.stock_level.asc(), Products.description).all()
-    stock_rows = ""
-    for p in products:
-        soh = p.stock_level or 0
-        if soh <= 3:
-            bg = "#fff3cd"
-            badge = f"<span style='background:#dc3545;color:white;padding:2px 8px;border-radius:10px;font-size:0.8em;'>LOW</span>"
-        elif soh <= 10:
-            bg = ""
-            badge = ""
-        else:
-            bg = ""
-            badge = ""
-        stock_rows += f"<tr style='background:{bg}'><td>{p.description or p.upc_code}</td><td>{p.category or ''}</td><td style='text-align:right;font-weight:bold'>{soh}</td><td>{badge}</td></tr>\n"
-
-    html = f"""
-    <div style="font-family:Arial,sans-serif;max-width:700px;margin:0 auto;color:#333;">
-        <div style="background:#1a5276;color:white;padding:20px 24px;border-radius:12px 12px 0 0;">
-            <h1 style="margin:0;font-size:1.5rem;">Snackshack Daily Report</h1>
-            <p style="margin:4px 0 0;opacity:0.85;">{report_date}</p>
-        </div>
-        <div style="padding:20px 24px;background:#f8f9fa;border:1px solid #ddd;">
-
-            <h2 style="color:#1a5276;border-bottom:2px solid #1a5276;padding-bottom:6px;margin-top:0;">
-                Daily Transactions
-            </h2>
-            <table style="width:100%;border-collapse:collapse;font-size:0.9rem;">
-                <thead>
-                    <tr style="background:#e9ecef;">
-                        <th style="padding:8px;text-align:left;">Time</th>
-                        <th style="padding:8px;text-align:left;">Staff</th>
-                        <th style="padding:8px;text-align:left;">Product</th>
-                        <th style="padding:8px;text-align:right;">Amount</th>
-                    </tr>
-                </thead>
-                <tbody>{tx_rows}</tbody>
-                <tfoot>
-                    <tr style="background:#e9ecef;font-weight:bold;">
-                        <td colspan="3" style="padding:8px;">Total</td>
-                        <td style="padding:8px;text-align:right;">${daily_total:.2f}</td>
-                    </tr>
-                </tfoot>
-            </table>
-
-            <h2 style="color:#1a5276;border-bottom:2px solid #1a5276;padding-bottom:6px;margin-top:24px;">
-                Staff Balances
-            </h2>
-            <table style="width:100%;border-collapse:collapse;font-size:0.9rem;">
-                <thead>
-                    <tr style="background:#e9ecef;">
-                        <th style="padding:8px;text-align:left;">Name</th>
-                        <th style="padding:8px;text-align:right;">Balance</th>
-                    </tr>
-                </thead>
-                <tbody>{bal_rows}</tbody>
-            </table>
-
-            <h2 style="color:#1a5276;border-bottom:2px solid #1a5276;padding-bottom:6px;margin-top:24px;">
-                Stock Report
-            </h2>
-            <table style="width:100%;border-collapse:collapse;font-size:0.9rem;">
-                <thead>
-                    <tr style="background:#e9ecef;">
-                        <th style="padding:8px;text-align:left;">Product</th>
-                        <th style="padding:8px;text-align:left;">Category</th>
-                        <th style="padding:8px;text-align:right;">Stock</th>
-                        <th style="padding:8px;"></th>
-                    </tr>
-                </thead>
-                <tbody>{stock_rows}</tbody>
-            </table>
-
-            <p style="margin-top:24px;font-size:0.8rem;color:#999;text-align:center;">
-                - Claudes Snackshack -
-            </p>
-        </div>
-    </div>"""
-    return html
-
-def send_nightly_report(app):
-    """Send the nightly report email to all super admins."""
-    with app.app_context():
-        admins = Users.query.filter_by(is_super_admin=True).all()
-        recipients = [a.email for a in admins if a.email]
-        if not recipients:
-            return False
-
-        smtp_host = os.environ.get('SMTP_HOST', 'mail.smtp2go.com')
-        smtp_port = int(os.environ.get('SMTP_PORT', 2525))
-        smtp_user = os.environ.get('SMTP_USER', '')
-        smtp_pass = os.environ.get('SMTP_PASS', '')
-        smtp_from = os.environ.get('SMTP_FROM', smtp_user)
-        if not smtp_user or not smtp_pass:
-            return False
-
-        html = generate_nightly_report_html(app)
-
-        for addr in recipients:
-            msg = MIMEMultipart('alternative')
-            msg['Subject'] = f"Snackshack Daily Report - {datetime.now().strftime('%d %b %Y')}"
-            msg['From'] = smtp_from
-            msg['To'] = addr
-            msg.attach(MIMEText(html, 'html'))
-            try:
-                with smtplib.SMTP(smtp_host, smtp_port) as server:
-                    server.starttls()
-                    server.login(smtp_user, smtp_pass)
-                    server.sendmail(smtp_from, addr, msg.as_string())
-            except Exception:
-                pass
-        return True
+# --- Nightly Report (job registered in jobs.py) ---
 
 @main.route('/admin/send-nightly-report')
 def trigger_nightly_report():
@@ -933,9 +924,52 @@ def trigger_nightly_report():
     if not u or not u.is_super_admin:
         flash("Super admin access required.", "danger")
         return redirect(url_for('main.index'))
-    result = send_nightly_report(current_app._get_current_object())
-    if result:
+    # Manual sends claim a per-minute slot so a double click can't send twice
+    slot = f"manual-{datetime.utcnow().strftime('%Y-%m-%dT%H:%M')}"
+    result = scheduler.run_job(current_app._get_current_object(), 'nightly_report', slot)
+    if result == 'ok':
         flash("Daily report emailed!", "success")
+    elif result == 'skipped':
+        flash("Daily report was already sent a moment ago.", "info")
     else:
         flash("Could not send report - check SMTP settings and super admin emails.", "warning")
-    return redirect(url_for('main.index'))
\ No newline at end of file
+    return redirect(url_for('main.index'))
+
+@main.route('/admin/nightly-report/preview')
+@main.route('/admin/nightly-report/<filename>')
+def preview_nightly_report(filename=None):
+    """Today's cached report as HTML, or one of its CSV attachments."""
+    u = Users.query.get(int(session['user_id'])) if 'user_id' in session else None
+    if not u or not u.is_super_admin:
+        flash("Super admin access required.", "danger")
+        return redirect(url_for('main.index'))
+    import reports
+    report = reports.get_report(refresh=request.args.get('refresh') == '1')
+    if filename is None:
+        return report['html']
+    if filename not in report['attachments']:
+        return "Not found", 404
+    resp = make_response(report['attachments'][filename])
+    resp.headers['Content-Type'] = 'text/csv; charset=utf-8'
+    resp.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return resp
+
+@main.route('/admin/jobs')
+def job_history():
+    """Recent scheduler runs with durations (super admins only)."""
+    u = Users.query.get(int(session['user_id'])) if 'user_id' in session else None
+    if not u or not u.is_super_admin:
+        return jsonify({"error": "super admin access required"}), 403
+    return jsonify({"runs": [{
+        "job": r.job_name, "slot": r.slot, "holder": r.holder, "status": r.status,
+        "started_at": r.started_at.isoformat() if r.started_at else None,
+        "duration_ms": r.duration_ms, "error": r.error,
+    } for r in scheduler.recent_runs()]})
+
+@main.route('/admin/lanes')
+def lane_stats():
+    """Per-lane request counts, queue wait and shedding for this worker (super admins only)."""
+    u = Users.query.get(int(session['user_id'])) if 'user_id' in session else None
+    if not u or not u.is_super_admin:
+        return jsonify({"error": "super admin access required"}), 403
+    return jsonify(lanes.stats())
@@ -0,0 +1,184 @@
+"""
+In-process job scheduler.
+
+Every gunicorn worker (and every scaled-out instance) runs a small daemon
+thread, but only the holder of the 'scheduler' row in Job_Leases actually
+runs jobs. The lease is renewed each tick and taken over by another worker
+once it expires, so a crashed or recycled worker hands off within
+SCHEDULER_LEASE_SECONDS.
+
+At-most-once: before running, a job claims its schedule slot by inserting a
+Job_Runs row; the unique (Job_Name, Slot) constraint means a second runner -
+a stale leader, the cron script or a double-clicked admin button - fails the
+insert and skips. The same row records duration and outcome. The leader
+deletes rows older than JOB_RUNS_RETENTION_DAYS once a day, since interval
+jobs add one per slot.
+
+Jobs are registered with register() (see jobs.py) and receive the Flask app.
+A job's function may be given as 'module:function' so its module is only
+imported when the job first runs.
+"""
+import os
+import time
+import calendar
+import uuid
+import importlib
+import socket
+import threading
+import traceback
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from models import db, JobLeases, JobRuns
+
+LEASE_NAME = 'scheduler'
+HOLDER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+_jobs = {}
+_started = {'thread': None}
+_pruned = {'day': None}
+
+class Job:
+    def __init__(self, name, func, every=None, daily_at=None, tz='Pacific/Auckland'):
+        self.name = name
+        self.func = func            # callable, or 'module:function' imported on first run
+        self.every = every          # timedelta, for interval jobs
+        self.daily_at = daily_at    # 'HH:MM' local time, for daily jobs
+        self.tz = tz
+        self.last_slot = None     # last slot this worker saw claimed, saves a doomed INSERT per tick
+
+    def current_slot(self, now_utc):
+        """Slot key for the most recent due time at or before now_utc, or None if not yet due."""
+        if self.every:
+            seconds = int(self.every.total_seconds())
+            epoch = calendar.timegm(now_utc.timetuple()) // seconds * seconds
+            return datetime.utcfromtimestamp(epoch).strftime('%Y-%m-%dT%H:%M')
+        now_local = self._local(now_utc)
+        hour, minute = (int(x) for x in self.daily_at.split(':'))
+        if (now_local.hour, now_local.minute) < (hour, minute):
+            return None
+        return now_local.strftime('%Y-%m-%d')
+
+    def resolve(self):
+        if isinstance(self.func, str):
+            module, _, attr = self.func.partition(':')
+            self.func = getattr(importlib.import_module(module), attr)
+        return self.func
+
+    def day_slot(self, now_utc):
+        """Slot key for today's run of a daily job, regardless of the time of day."""
+        return self._local(now_utc).strftime('%Y-%m-%d')
+
+    def _local(self, now_utc):
+        import pytz
+        return pytz.utc.localize(now_utc).astimezone(pytz.timezone(self.tz))
+
+def register(name, func, every=None, daily_at=None):
+    """Register a periodic job. Give exactly one of every (timedelta) or daily_at ('HH:MM' NZ time)."""
+    if (every is None) == (daily_at is None):
+        raise ValueError("register() needs exactly one of every or daily_at")
+    _jobs[name] = Job(name, func, every=every, daily_at=daily_at)
+    return _jobs[name]
+
+def get_job(name):
+    return _jobs[name]
+
+def all_jobs():
+    return dict(_jobs)
+
+def _lease_seconds():
+    return int(os.environ.get('SCHEDULER_LEASE_SECONDS', '60'))
+
+def acquire_lease():
+    """Take or renew the scheduler lease. Returns True if this worker is the leader."""
+    now = datetime.utcnow()
+    expires = now + timedelta(seconds=_lease_seconds())
+    updated = JobLeases.query.filter(
+        JobLeases.name == LEASE_NAME,
+        db.or_(JobLeases.holder == HOLDER, JobLeases.expires_at < now)
+    ).update({JobLeases.holder: HOLDER, JobLeases.expires_at: expires}, synchronize_session=False)
+    if updated:
+        db.session.commit()
+        return True
+    try:
+        db.session.add(JobLeases(name=LEASE_NAME, holder=HOLDER, expires_at=expires))
+        db.session.commit()
+        return True
+    except IntegrityError:
+        db.session.rollback()  # somebody else holds a live lease
+        return False
+
+def claim(job_name, slot):
+    """Insert the Job_Runs row for (job_name, slot). Returns it, or None if already claimed."""
+    run = JobRuns(job_name=job_name, slot=slot, holder=HOLDER, status='running')
+    db.session.add(run)
+    try:
+        db.session.commit()
+        return run
+    except IntegrityError:
+        db.session.rollback()
+        return None
+
+def run_job(app, name, slot):
+    """Claim slot for job name and run it. Returns 'skipped', 'ok', 'failed' or 'error'."""
+    job = _jobs[name]
+    run = claim(name, slot)
+    if run is None:
+        return 'skipped'
+    started = time.monotonic()
+    try:
+        status = 'ok' if job.resolve()(app) is not False else 'failed'
+        error = None
+    except Exception:
+        db.session.rollback()
+        status, error = 'error', traceback.format_exc()[-500:]
+    run.finished_at = datetime.utcnow()
+    run.duration_ms = int((time.monotonic() - started) * 1000)
+    run.status, run.error = status, error
+    db.session.commit()
+    return status
+
+def prune_runs(now):
+    """Delete Job_Runs rows started more than JOB_RUNS_RETENTION_DAYS ago (0 keeps them all). Returns the count."""
+    days = int(os.environ.get('JOB_RUNS_RETENTION_DAYS', '30'))
+    if days <= 0:
+        return 0
+    deleted = JobRuns.query.filter(JobRuns.started_at < now - timedelta(days=days)).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+def tick(app):
+    """One scheduler pass: renew the lease, run any due, unclaimed slots and prune old runs daily."""
+    with app.app_context():
+        try:
+            if not acquire_lease():
+                return
+            now = datetime.utcnow()
+            for job in list(_jobs.values()):
+                slot = job.current_slot(now)
+                if slot and slot != job.last_slot:
+                    run_job(app, job.name, slot)
+                    job.last_slot = slot
+            if _pruned['day'] != now.date():
+                prune_runs(now)
+                _pruned['day'] = now.date()
+        finally:
+            db.session.remove()
+
+def _loop(app):
+    interval = int(os.environ.get('SCHEDULER_TICK_SECONDS', '20'))
+    while True:
+        try:
+            tick(app)
+        except Exception:
+            pass  # DB blip - try again next tick
+        time.sleep(interval)
+
+def start(app):
+    """Start the scheduler thread for this worker (idempotent; disable with SCHEDULER_ENABLED=0)."""
+    if os.environ.get('SCHEDULER_ENABLED', '1') == '0' or _started['thread']:
+        return
+    _started['thread'] = threading.Thread(target=_loop, args=(app,), daemon=True, name='scheduler')
+    _started['thread'].start()
+
+def recent_runs(limit=50):
+    return JobRuns.query.order_by(JobRuns.started_at.desc()).limit(limit).all()
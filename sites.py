@@ -0,0 +1,126 @@
+"""
+Multi-site scoping: several snack shacks served by one deployment.
+
+Sites are configured with SNACKSHACK_SITES, a JSON list such as
+
+    [{"id": 1, "name": "Wellington", "hosts": ["wlg.snackshack.nz"], "token": "..."},
+     {"id": 2, "name": "Auckland", "hosts": ["akl.snackshack.nz"], "token": "..."}]
+
+and default to a single site 1 (every existing row is site 1).
+
+Each request is resolved to one site: a kiosk token (?kiosk=<token> or the
+X-Kiosk-Token header, remembered in the session), else the hostname with any
+mobile 'm.' prefix stripped, else the first site. Every ORM query on a
+SiteScoped model (Users, Products, Transactions, Wallpapers) is then filtered
+to that site and new rows are stamped with it, so routes and helper modules
+need no site-specific code. Code running outside a request (scheduler jobs)
+sees all sites unless it enters use_site().
+
+Per-worker caches key their entries by current_id().
+"""
+import os
+import hmac
+import json
+from contextlib import contextmanager
+from flask import g, request, session, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session, with_loader_criteria
+from models import missing_site_columns, SiteScoped, Users, Products, Transactions, Wallpapers
+
+_schema = {'ready': False}
+
+def all_sites():
+    """Configured sites as dicts with id, name, hosts and token."""
+    raw = os.environ.get('SNACKSHACK_SITES')
+    sites = json.loads(raw) if raw else [{'id': 1, 'name': 'Snackshack'}]
+    return [{'id': int(s['id']), 'name': s.get('name') or f"Site {s['id']}",
+             'hosts': [h.lower() for h in s.get('hosts', [])], 'token': s.get('token')} for s in sites]
+
+def get_site(site_id):
+    return next((s for s in all_sites() if s['id'] == site_id), None)
+
+def current_id():
+    """Site id for this request or use_site() block, or None when unscoped."""
+    return g.get('site_id') if has_app_context() else None
+
+def current():
+    return get_site(current_id()) if current_id() is not None else None
+
+def check_schema():
+    """Refuse to serve a database `python jobs.py migrate` hasn't upgraded yet (checked once per worker)."""
+    if not _schema['ready']:
+        missing = missing_site_columns(Users, Products, Transactions, Wallpapers)
+        if missing:
+            raise RuntimeError(f"{', '.join(missing)} lack Site_ID - run `python jobs.py migrate`")
+        _schema['ready'] = True
+
+@contextmanager
+def use_site(site_id):
+    """Scope queries in this block to one site (for jobs and scripts)."""
+    previous = g.get('site_id')
+    g.site_id = site_id
+    try:
+        yield get_site(site_id)
+    finally:
+        g.site_id = previous
+
+def base_host(host):
+    """Request host without port or the mobile 'm.' prefix (see routes.is_mobile_site)."""
+    host = host.split(':')[0].lower()
+    return host[2:] if host.startswith('m.') else host
+
+def _site_for_token(token):
+    if not token:
+        return None
+    for site in all_sites():
+        if site['token'] and hmac.compare_digest(str(site['token']), token):
+            return site
+    return None
+
+def resolve():
+    """Pick the site for the current request: kiosk token, then hostname, then the first site."""
+    sites = all_sites()
+    site = _site_for_token(request.headers.get('X-Kiosk-Token') or request.args.get('kiosk'))
+    if site:
+        if session.get('site_id') != site['id']:
+            session.pop('user_id', None)  # a login never carries over to another shop
+        session['site_id'] = site['id']
+        return site['id']
+    if session.get('site_id') and get_site(session['site_id']):
+        return session['site_id']
+    host = base_host(request.host)
+    for site in sites:
+        if host in site['hosts']:
+            return site['id']
+    return sites[0]['id']
+
+@event.listens_for(Session, 'do_orm_execute')
+def _scope_to_site(state):
+    site_id = current_id()
+    if site_id is None or state.is_column_load or state.is_relationship_load:
+        return
+    if state.is_select or state.is_update or state.is_delete:
+        state.statement = state.statement.options(
+            with_loader_criteria(SiteScoped, lambda cls: cls.site_id == site_id, include_aliases=True))
+
+@event.listens_for(Session, 'before_flush')
+def _stamp_new_rows(session_, flush_context, instances):
+    site_id = current_id()
+    if site_id is None:
+        return
+    for obj in session_.new:
+        if isinstance(obj, SiteScoped) and obj.site_id is None:
+            obj.site_id = site_id
+
+def init_templates(app):
+    """Expose the current site to templates - web pages and job-rendered reports alike."""
+    @app.context_processor
+    def _site_context():
+        return {'current_site': current(), 'multi_site': len(all_sites()) > 1}
+
+def init_app(app):
+    """Resolve the site for every request."""
+    @app.before_request
+    def _set_site():
+        check_schema()
+        g.site_id = resolve()
@@ -0,0 +1,8 @@
+#!/bin/sh
+# App Service startup command (set by the deploy workflow's startup-command).
+# Brings the database schema up to models.py before any worker serves a request;
+# if that fails the container doesn't start and App Service retries it, rather
+# than serving a schema the code can't use. Gunicorn settings: gunicorn.conf.py.
+set -e
+python jobs.py migrate
+exec gunicorn --bind=0.0.0.0:${PORT:-8000} --timeout 600 app:app
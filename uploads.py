@@ -0,0 +1,127 @@
+"""
+Bounded-memory image ingestion.
+
+Images are stored in the database as data URIs. Building one in Python means
+holding the raw bytes, their base64 text and the formatted URI at once
+(3-4x the file size), so uploads are streamed into the column instead:
+
+  1. reject_oversize() turns the request away from its Content-Length
+     before the multipart body is parsed at all;
+  2. the type is sniffed from the file's magic bytes - the filename and
+     browser-supplied content type are not trusted;
+  3. the column is set to the data-URI prefix and then extended with one
+     base64 piece per CHUNK_SIZE bytes (UPDATE ... SET col = col + :piece),
+     with a running byte count as a second size guard.
+
+Werkzeug already spools multipart files over 500 KB to a temporary file, so a
+worker holds at most one chunk of each upload in memory.
+
+Pasted images (the image_base64 form field) arrive as text already; they are
+size-checked from their length and validated a chunk at a time, never
+decoded in full.
+"""
+import re
+import base64
+import binascii
+from flask import request
+from models import db
+
+CHUNK_SIZE = 384 * 1024  # a multiple of 3, so base64 pieces concatenate without padding
+FORM_OVERHEAD = 64 * 1024  # multipart boundaries and the other form fields
+
+_DATA_URI = re.compile(r'^data:image/(png|jpe?g|gif|webp);base64,')
+
+class UploadError(Exception):
+    """An upload was refused; the message is shown to the user."""
+
+def sniff(head):
+    """Image type ('png', 'jpeg', 'gif', 'webp') from the first bytes of a file, or None."""
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+def _too_large(limit):
+    return UploadError(f"Image too large (max {limit // (1024 * 1024)} MB).")
+
+def reject_oversize(limit, encoded=False):
+    """Raise UploadError if the request body can't possibly fit an image of limit bytes.
+
+    encoded: the image may arrive base64-encoded in a form field (4/3 the size).
+    """
+    allowance = limit * 4 // 3 if encoded else limit
+    if request.content_length is not None and request.content_length > allowance + FORM_OVERHEAD:
+        raise _too_large(limit)
+
+def _stream_size(stream):
+    try:
+        pos = stream.tell()
+        stream.seek(0, 2)
+        size = stream.tell()
+        stream.seek(pos)
+        return size
+    except (AttributeError, OSError, ValueError):
+        return None  # not seekable - the running count still applies
+
+def store_file(file, limit, obj, attr):
+    """Stream an uploaded image into obj.<attr> as a data URI. Returns the sniffed type.
+
+    obj must already be flushed (it is updated by primary key). The caller
+    commits, or rolls back on UploadError.
+    """
+    stream = file.stream
+    size = _stream_size(stream)
+    if size is not None and size > limit:
+        raise _too_large(limit)
+    head = stream.read(CHUNK_SIZE)
+    mime = sniff(head)
+    if not mime:
+        raise UploadError("Unsupported image format.")
+
+    mapper = db.inspect(obj).mapper
+    table = mapper.local_table
+    column = mapper.get_property(attr).columns[0]
+    where = [pk == value for pk, value in zip(mapper.primary_key, mapper.primary_key_from_instance(obj))]
+
+    def write(value):
+        db.session.execute(db.update(table).where(*where).values({column: value}))
+
+    write(f"data:image/{mime};base64,")
+    total, chunk = 0, head
+    while chunk:
+        total += len(chunk)
+        if total > limit:
+            raise _too_large(limit)
+        write(column + base64.b64encode(chunk).decode('ascii'))
+        chunk = stream.read(CHUNK_SIZE)
+    db.session.expire(obj, [attr])  # the ORM copy is stale; reload it only if someone reads it
+    return mime
+
+def check_data_uri(value, limit):
+    """Validate a pasted data-URI image without decoding it in full. Returns the sniffed type."""
+    match = _DATA_URI.match(value)
+    if not match:
+        raise UploadError("Unsupported image format.")
+    payload_start = match.end()
+    payload_len = len(value) - payload_start
+    if payload_len * 3 // 4 - value.count('=', len(value) - 2) > limit:
+        raise _too_large(limit)
+    step = CHUNK_SIZE // 3 * 4  # base64 characters per CHUNK_SIZE bytes
+    mime = None
+    for start in range(payload_start, len(value), step):
+        try:
+            piece = base64.b64decode(value[start:start + step], validate=True)
+        except (binascii.Error, ValueError):
+            raise UploadError("Image data is corrupt.")
+        if mime is None:
+            mime = sniff(piece)
+            if not mime:
+                raise UploadError("Unsupported image format.")
+    if mime is None:
+        raise UploadError("Image data is empty.")
+    return mime